@@ -1,5 +1,5 @@
 from langgraph.graph import StateGraph, START, END
-from langchain.schema import HumanMessage
+from langchain_core.messages import HumanMessage
 
 from typing_extensions import TypedDict
 from pydantic import BaseModel, Field
@@ -40,13 +40,16 @@ def description_agent(state: State) -> State:
 def text_extractor_agent(state: State) -> State:
     doc = get_document_client()
 
-    file = open(state["image"], "rb")
+    try:
+        with open(state["image"], "rb") as file:
+            poller = doc.begin_analyze_document(
+                "prebuilt-layout", body=file
+            )
 
-    poller = doc.begin_analyze_document(
-        "prebuilt-layout", body=file
-    )
+            extracted_text = poller.result()["content"]
+    finally:
+        doc.close()
 
-    extracted_text = poller.result()["content"]
     return {"extracted_text": extracted_text}
 
 def result_agent(state: State) -> State:
@@ -100,7 +103,9 @@ def draw_mermaid():
         f.write(png_image)
 
 
-draw_mermaid()
+if __name__ == "__main__":
+    draw_mermaid()
+
 ### USAGE 
        
 # app = compile_graph()
@@ -59,7 +59,7 @@ def decide(state: State) -> State:
     pred_top_N = state["predicted_topn"]
 
     if 3 <= pred_top_N <= 7 and pred_top_N != 5:
-        search_args = {"top": 5, "knn": 15}
+        search_args = {**state["get_response_kwargs"].get("search_kwargs", {}), "top": 5, "knn": 15} # keep filters
         state["get_response_kwargs"]["search_kwargs"] = search_args
         return "new_response"
     
@@ -91,7 +91,9 @@ def draw_mermaid():
         f.write(png_image)
 
 
-draw_mermaid()
+if __name__ == "__main__":
+    draw_mermaid()
+
 
 ### USAGE 
        
@@ -3,7 +3,7 @@ import gradio as gr
 import uvicorn
 
 from mmrag import SYSTEM_MESSAGE_TEMPLATE, Response
-from utils.azure_utils import get_response
+from utils.azure_utils import get_response, build_filter, get_facets, format_facets
 
 
 ### FASTAPI BACKEND ###
@@ -17,14 +17,20 @@ async def health_check():
 
 ### GRADIO FRONTEND ###
 
-def gradio_bot_response(query, chat, state):
+def gradio_bot_response(query, chat, state, source, pages, facets):
     if not state.get("history", None): ### REAL CHAT HISTORY
         state["history"] = []
 
+    try:
+        search_filter = build_filter(source=source.strip() or None, pages=pages.strip() or None) # optional scope of the search
+    except ValueError as e:
+        raise gr.Error(str(e))
+
     response, sources, _ = get_response(query=query, 
                                         sys_template=SYSTEM_MESSAGE_TEMPLATE, 
                                         messages=state["history"], # remove citations from chat history
                                         search_type="vector_text", 
+                                        search_kwargs={"filter": search_filter} if search_filter else {},
                                         openai_kwargs={"temperature":0.1, "max_tokens":None},
                                         output_schema=Response) # LLM response + retrieved sources
 
@@ -50,6 +56,13 @@ def gradio_bot_response(query, chat, state):
                         role="assistant",
                         content=sources,
                         metadata={"title": "📚 Citations", "status":"done"}))
+
+        if facets.strip():
+            chat.append(
+                        gr.ChatMessage(
+                            role="assistant",
+                            content=format_facets(get_facets(query, facets.split(), filter=search_filter)),
+                            metadata={"title": "📊 Facets", "status":"done"}))
         
         ### REAL CHAT HISTORY UPDATE
         user_msg = {"role": "user", "content": f"{query}"}
@@ -72,11 +85,16 @@ with gr.Blocks(theme=gr.themes.Ocean()) as demo:
     chatbot = gr.Chatbot(type="messages")
     state = gr.State(value={})
 
+    with gr.Row():
+        source = gr.Textbox(label="Source", placeholder="All documents")
+        pages = gr.Textbox(label="Pages", placeholder="All pages, or e.g. 3-7, 3-, -7")
+        facets = gr.Textbox(label="Facets", placeholder="None, or e.g. source page,interval:10")
+
     user_input = gr.Textbox(show_label=False, placeholder="Type your message here...", submit_btn=True)
     
     user_input.submit(
         gradio_bot_response,
-        inputs=[user_input, chatbot, state],
+        inputs=[user_input, chatbot, state, source, pages, facets],
         outputs=[user_input, chatbot, state],
         show_progress_on=[chatbot, state],
     )
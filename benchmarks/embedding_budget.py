@@ -0,0 +1,68 @@
+import time
+from types import SimpleNamespace
+
+from index.embedding import Embedder
+from index.scheduler import EmbeddingScheduler
+
+
+#########CONFIG#########
+
+tpm = 60_000
+first_call_texts = 60 # ~1000 tokens each, i.e. the whole minute budget
+second_call_texts = 3
+
+########################
+
+
+class FakeEmbeddingsClient():
+    """
+        Stands in for the async EmbeddingsClient: answers immediately and counts instances
+    """
+    instances = 0
+
+    def __init__(self):
+        FakeEmbeddingsClient.instances += 1
+
+    async def embed(self, input, model, **kwargs):
+        return SimpleNamespace(data=[SimpleNamespace(index=i, embedding=[0.0]) for i in range(len(input))])
+
+    async def close(self):
+        pass
+
+
+def main():
+    """
+        Two consecutive embed_many calls must share one TPM budget: the second one waits for the bucket to refill
+    """
+    emb = Embedder(max_batch_inputs=8, scheduler=EmbeddingScheduler(tpm=tpm))
+    emb.client = FakeEmbeddingsClient()
+
+    first = [f"first {i} " + "word " * 1000 for i in range(first_call_texts)]
+    second = [f"second {i} " + "word " * 1000 for i in range(second_call_texts)]
+
+    second_tokens = int(emb.count_tokens(second).sum())
+    expected_wait = second_tokens / (tpm / 60) * 0.9 # bucket refills during the first call too
+
+    start = time.perf_counter()
+    emb.embed_many(first)
+    first_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    emb.embed_many(second)
+    second_elapsed = time.perf_counter() - start
+
+    stats = emb.scheduler.stats()
+    emb.close()
+
+    print(f"first call {first_elapsed:.2f}s, second call {second_elapsed:.2f}s (expected >= {expected_wait - first_elapsed:.2f}s)")
+    print(f"scheduler: {stats}")
+
+    assert second_elapsed >= expected_wait - first_elapsed, "second call did not wait for the shared TPM budget"
+    assert FakeEmbeddingsClient.instances == 1, "embedding client was not reused"
+
+    print("OK")
+
+
+
+if __name__ == "__main__":
+    main()
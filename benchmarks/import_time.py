@@ -0,0 +1,72 @@
+import os
+import sys
+import time
+import subprocess
+
+
+#########CONFIG#########
+
+modules = [
+    "index.document",
+    "index.embedding",
+    "index.index",
+    "index.storage",
+    "index.indexer",
+    "utils.azure_utils",
+    "agents.image_agents",
+    "agents.rag_agents",
+    "mmrag",
+    "create_index",
+    "app.app",
+]
+
+top_imports = 5
+
+########################
+
+
+def import_time(module):
+    """
+        Import module in a fresh interpreter, returns wall time and its slowest direct imports from -X importtime
+    """
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [os.getcwd(), os.environ.get("PYTHONPATH")]))}
+
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True, env=env)
+    elapsed = time.perf_counter() - start
+
+    if process.returncode != 0:
+        return elapsed, None, [line for line in process.stderr.splitlines() if not line.startswith("import time:")][-1]
+
+    # lines look like: "import time:   self [us] | cumulative | imported package"
+    imports = []
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        imports.append((int(cumulative), name.rstrip()))
+
+    # direct imports of the module (one nesting level, i.e. 2 more spaces)
+    direct = [(us, name.strip()) for us, name in imports if name.startswith("   ") and not name.startswith("     ")]
+    direct.sort(reverse=True)
+
+    return elapsed, direct[:top_imports], None
+
+
+def main():
+    print(f"{'module':<22}{'wall (s)':>10}   slowest direct imports")
+
+    for module in modules:
+        elapsed, top, error = import_time(module)
+
+        if error:
+            print(f"{module:<22}{elapsed:>10.2f}   failed: {error}")
+            continue
+
+        slowest = ", ".join(f"{name} {us/1e6:.2f}s" for us, name in top)
+        print(f"{module:<22}{elapsed:>10.2f}   {slowest}")
+
+
+
+if __name__ == "__main__":
+    main()
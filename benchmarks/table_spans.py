@@ -0,0 +1,88 @@
+import glob
+import pickle
+import random
+import timeit
+
+from index.document import DocumentProcessor
+from index.spans import SpanIndex
+
+
+#########CONFIG#########
+
+pkl_files = sorted(glob.glob("data/*.pkl"))
+repeat = 20
+
+synthetic_tables = 2000
+synthetic_queries = 20000
+
+########################
+
+
+def linear_find(spans, offset):
+    # lookup previously done in format_paragraphs
+    found = None
+    for i, s in enumerate(spans):
+        if s["offset"] <= offset <= (s["offset"]+s["length"]):
+            found = i
+    return found
+
+
+def get_spans(table_result):
+    spans = []
+    for table in table_result.tables:
+        table_min_offset = min([span["offset"] for span in table.spans])
+        table_max_length = max([span["length"] for span in table.spans])
+        spans.append({"offset": table_min_offset, "length": table_max_length})
+    return spans
+
+
+def compare(name, spans, span_index, offsets):
+    legacy = [linear_find(spans, o) for o in offsets]
+    indexed = [span_index.find(o) for o in offsets]
+
+    assert legacy == indexed, f"{name}: lookups differ"
+
+    legacy_time = min(timeit.repeat(lambda: [linear_find(spans, o) for o in offsets], number=1, repeat=repeat))
+    indexed_time = min(timeit.repeat(lambda: [span_index.find(o) for o in offsets], number=1, repeat=repeat))
+
+    print(f"{name}: {len(spans)} tables, {len(offsets)} lookups | "
+          f"linear {legacy_time*1e3:.3f} ms, bisect {indexed_time*1e3:.3f} ms, speedup x{legacy_time/max(indexed_time, 1e-9):.1f}")
+
+
+def main():
+    doc = DocumentProcessor(root_path=".", use_images=False)
+
+    for pkl_file in pkl_files:
+        with open(pkl_file, "rb") as fin:
+            results = pickle.load(fin)
+
+        for doc_res in results["documents"]:
+            result = doc_res["result"]
+
+            _, span_index = doc.get_tables(result)
+            spans = get_spans(result)
+
+            offsets = [span["offset"] for paragraph in result.paragraphs for span in paragraph.spans for _ in paragraph.bounding_regions]
+
+            compare(f"{pkl_file} [{doc_res['file_name']} @{doc_res['split_offset']}]", spans, span_index, offsets)
+
+    # table-heavy synthetic document
+    random.seed(0)
+
+    spans, offset = [], 0
+    for _ in range(synthetic_tables):
+        offset += random.randint(50, 500)
+        length = random.randint(100, 2000)
+        spans.append({"offset": offset, "length": length})
+        offset += length
+
+    offsets = [random.randint(0, offset) for _ in range(synthetic_queries)]
+
+    compare("synthetic", spans, SpanIndex(spans), offsets)
+
+    print("\nTable lookups (hence format_paragraphs outputs) are identical.")
+
+
+
+if __name__ == "__main__":
+    main()
@@ -1,60 +1,289 @@
 from index.document import DocumentProcessor
+from index.chunker import Chunker
 from index.embedding import Embedder
 from index.index import Index
 from index.storage import Storage
 from index.indexer import Indexer
+from index.pipeline import Pipeline
+from index.manifest import IndexManifest
+from utils.embedding_cache import EmbeddingCache
+from utils.index_pointer import get_active_index, get_previous_indexes
 
 
-def create_index(use_image: bool = True, use_vector: bool = True):
+def prepare_index(index: Index, stor: Storage):
+    print("\nDeleting search index if it exists...")
+    index.delete_index_if_exists()
+
+    print("\nCreating new search index...")
+    index.create_search_index()
+
+    print("\nCreating new data source connection...")
+    stor.connect_to_container()
+
+    print("\nErasing all blobs in the container...")
+    stor.erase_container()
+
+    # the index is recreated and the container is shared by the index versions: none of their manifests match anymore
+    for name in {index.index_name, get_active_index(index.base_index_name), *get_previous_indexes(index.base_index_name)}:
+        IndexManifest(name).delete()
+
+
+def iter_recorded(chunks, manifest: IndexManifest, hashes: dict, blobs: dict, title_field: str):
+    """
+        Yields the chunks to the container upload, recording id -> content hash before and id -> blob name after (names are resolved on upload)
+    """
+    for chunk in chunks:
+        chunk_hash = manifest.chunk_hash(chunk)
+        yield chunk
+        hashes[chunk["id"]], blobs[chunk["id"]] = chunk_hash, chunk[title_field]
+
+
+def save_manifest(index: Index, stor: Storage, manifest: IndexManifest, hashes: dict, blobs: dict, failed_names: list):
+    # a full rebuild replaces what the next incremental run diffs against
+    if stor.pack_size: # packs hold many chunks, the next incremental run refuses them instead of diffing
+        manifest.delete()
+        return
+
+    failed_names = set(failed_names)
+    ids = [x for x in hashes if blobs[x] not in failed_names] # failed uploads count as added next time
+
+    manifest.save(index.get_schema_hash(), {x: hashes[x] for x in ids}, {x: blobs[x] for x in ids})
+
+
+def discard_version(index: Index, indexer: Indexer = None):
+    print(f"\nIndex '{index.index_name}' incomplete, queries stay on '{get_active_index(index.base_index_name)}'.")
+
+    if indexer: # it targets the discarded version, a later run would write into an index no query reads
+        print(f"Deleting indexer '{indexer.indexer_name}', the next full rebuild creates it again...")
+        indexer.delete_indexer()
+
+    print(f"Deleting index '{index.index_name}'...")
+    index.delete_index_if_exists()
+    IndexManifest(index.index_name).delete()
+
+
+def promote_index(index: Index, expected_count: int, indexer: Indexer = None, keep: int = 1):
+    print(f"\nWaiting for {expected_count} documents in '{index.index_name}'...")
+    if not index.wait_for_count(expected_count):
+        discard_version(index, indexer)
+        return
+
+    print("\nSwapping the active index...")
+    index.promote()
+
+    print("\nDeleting old index versions...")
+    index.delete_old_versions(keep=keep)
+
+
+def incremental_index(doc: DocumentProcessor, result, index: Index, stor: Storage, emb: Embedder = None):
+    # the container gets the same diff as the index, so that use_all_sources and any later indexer run stay in sync
+    assert not stor.pack_size, "incremental runs need one blob per chunk, run without --pack-size"
+
+    manifest = IndexManifest(index.index_name)
+    previous = manifest.load()
+
+    schema = index.get_schema_hash()
+
+    previous_blobs, stale_blobs = previous["blobs"], previous["stale_blobs"]
+
+    if previous["schema"] and previous["schema"] != schema:
+        print("\nSchema changed, recreating search index...")
+        index.delete_index_if_exists()
+        index.create_search_index()
+        stor.erase_container()
+        previous["chunks"], previous_blobs, stale_blobs = {}, {}, []
+    elif not index.index_exists():
+        print("\nCreating new search index...")
+        index.create_search_index()
+        stor.erase_container()
+        previous["chunks"], previous_blobs, stale_blobs = {}, {}, []
+    elif not previous["schema"]:
+        # no manifest yet: updating is harmless, and the ids already indexed are content hashes
+        print("\nUpdating search index...")
+        index.create_search_index()
+        previous["chunks"] = dict.fromkeys(index.get_document_ids())
+
+        stor.list_container() # refreshes the snapshot of blob name -> chunks
+        snapshot = stor.load_snapshot()
+        assert not any(name.endswith(".jsonl") for name in snapshot), \
+            f"container '{stor.container_name}' holds json-lines packs of a --pack-size rebuild, run a full rebuild without --pack-size first"
+        previous_blobs = {chunk["id"]: name for name, entry in snapshot.items() for chunk in entry["chunks"] if "id" in chunk}
+    else:
+        print("\nSchema unchanged, keeping the search index.")
+
+    paragraphs = list(doc.iter_result(result))
+
+    added, changed, removed, chunks = manifest.diff(previous["chunks"], paragraphs)
+    print(f"   {len(added)} added, {len(changed)} changed, {len(removed)} removed, {len(paragraphs) - len(added) - len(changed)} unchanged chunks")
+
+    paragraphs = added + changed
+
+    if emb and paragraphs:
+        print("\nAssessing tokens number...")
+        assert emb.tokens_number_test(paragraphs) ==  "succeded" # Less than 1k
+
+        print("\nEmbedding text...")
+        paragraphs = emb.get_chunk_objects(paragraphs) # Add vector field
+
+    # old blobs of changed and removed chunks (and of uploads left over by a failed run), plus those not deleted last time
+    old_blobs = stale_blobs + [previous_blobs[x] for x in [p["id"] for p in paragraphs] + removed if x in previous_blobs]
+
+    if old_blobs:
+        print("\nDeleting old blobs from the container...")
+        stale_blobs = stor.delete_from_container(old_blobs)["failed_names"]
+
+    failed_keys, failed_names = set(), set()
+
+    if paragraphs:
+        # blobs first: like in the full rebuild, blob names are written back into the headers
+        print("\nLoading chunks into the container...")
+        failed_names.update(stor.upload_to_container(paragraphs)["failed_names"])
+        failed_keys.update(p["id"] for p in paragraphs if p[stor.title_field] in failed_names)
+
+        print("\nMerging chunks into the search index...")
+        failed_keys.update(index.upload_to_index(paragraphs)["failed_keys"])
+
+    failed_deletes = []
+
+    if removed:
+        print("\nDeleting removed chunks from the search index...")
+        failed_deletes = index.delete_from_index(removed)
+        print(f"   {len(removed) - len(failed_deletes)} deleted, {len(failed_deletes)} failed")
+
+    blobs = {x: name for x, name in previous_blobs.items() if x in chunks and x not in failed_keys}
+    blobs.update({p["id"]: p[stor.title_field] for p in paragraphs if p[stor.title_field] not in failed_names})
+
+    # failed uploads are left out of the manifest and failed deletes kept in it, so the next run retries them
+    for key in failed_keys:
+        chunks.pop(key, None)
+
+    for key in failed_deletes:
+        chunks[key] = previous["chunks"][key]
+
+    manifest.save(schema, chunks, blobs, stale_blobs)
+
+
+def create_index(use_image: bool = True, use_vector: bool = True, use_layout: bool = False, use_parquet: bool = False, stream: bool = False, incremental: bool = False, push: bool = False, blue_green: bool = False, wait: bool = False, pack_size: int = 0, chunk_tokens: int = 512, chunk_overlap: int = 64, max_queue_size: int = 64):
 
     pdf_root = "Microsoft AI study"
     pkl_file = "data/microsoftStudy_results.pkl"
+    layout_cache_dir = "data/layout_cache"
+    layout_dir = "data/microsoftStudy_layout"
+
+    chunker = Chunker(max_tokens=chunk_tokens, overlap_tokens=chunk_overlap) if chunk_tokens else None # legacy header merging otherwise
 
-    doc = DocumentProcessor(root_path=pdf_root, use_images=use_image)
+    doc = DocumentProcessor(root_path=pdf_root, use_images=use_image, chunker=chunker)
 
     if use_vector:
-        emb = Embedder(format_content_field="format_content")
+        emb = Embedder(format_content_field="format_content", cache=EmbeddingCache()) # unchanged chunks are not embedded again
 
     index = Index(title_field="header", use_vector=use_vector)
 
-    stor = Storage(title_field="header")
+    if blue_green: # build a new version while the active one keeps serving queries
+        assert not (stream or incremental), "blue/green rebuilds need the whole corpus at once"
+        index = Index(title_field="header", use_vector=use_vector, index_name=index.get_version_name())
+
+    stor = Storage(title_field="header", pack_size=pack_size)
 
-    indexer = Indexer()
+    indexer = Indexer(index_name=index.index_name, parsing_mode="jsonLines" if pack_size else "json")
 
     print("\nRetrieving information...")
-    # result = doc.create_from_layout(save_to_file=pkl_file)
-    result = doc.create_from_pkl(path_to_file=pkl_file)
+    if use_layout:
+        result = doc.create_from_layout(save_to_file=pkl_file, cache_dir=layout_cache_dir)
+        if use_parquet:
+            doc.export_to_parquet(result, layout_dir)
+    elif use_parquet:
+        result = doc.create_from_parquet(path_to_dir=layout_dir)
+    else:
+        result = doc.create_from_pkl(path_to_file=pkl_file)
 
-    print("\nFormatting text...")
-    result = doc.format_result(result)
-    # doc.visualize_result(result)
-    paragraphs = doc.flatten_result(result)
+    if incremental:
+        incremental_index(doc, result, index, stor, emb=emb if use_vector else None)
 
-    if use_vector:
-        print("\nAssessing tokens number...")
-        assert emb.tokens_number_test(paragraphs) ==  "succeded" # Less than 1k
+        if use_vector:
+            emb.close()
 
-        print("\nEmbedding text...")
-        paragraphs = [emb.get_chunk_object(x) for x in paragraphs] # Add id and vector fields
+        print("\nFinished.")
+        return
 
-    print("\nDeleting search index if it exists...")
-    index.delete_index_if_exists()
+    if stream:
+        prepare_index(index, stor)
 
-    print("\nCreating new search index...")
-    index.create_search_index()
+        print("\nStreaming text formatting, embedding and loading into the container...")
+        pipeline = Pipeline(max_queue_size=max_queue_size)
 
-    print("\nCreating new data source connection...")
-    stor.connect_to_container()
+        if use_vector:
+            pipeline.add_stage(emb.check_tokens) # Less than 1k
+            pipeline.add_stage(emb.iter_chunk_objects) # Add vector field
 
-    print("\nErasing all blobs in the container...")
-    stor.erase_container()
+        manifest, hashes, blobs = IndexManifest(index.index_name), {}, {}
+        summary = pipeline.run(doc.iter_result(result), lambda chunks: stor.upload_to_container(iter_recorded(chunks, manifest, hashes, blobs, stor.title_field)))
+        save_manifest(index, stor, manifest, hashes, blobs, summary["failed_names"])
+
+    else:
+        print("\nFormatting text...")
+        result = doc.format_result(result)
+        # doc.visualize_result(result)
+        paragraphs = doc.flatten_result(result)
+
+        if use_vector:
+            print("\nAssessing tokens number...")
+            profile = emb.token_profile(paragraphs)
+            print(f"{profile['chunks']} chunks, {profile['total']} tokens (p50 {profile['p50']:.0f}, p95 {profile['p95']:.0f}, max {profile['max']}), "
+                  f"{profile['requests']} requests, cost {profile['cost']}, minutes at quota {profile['minutes']}")
+            assert not profile["over"], f"Chunks over 1k tokens: {profile['over']}" # Less than 1k
+
+            print("\nEmbedding text...")
+            paragraphs = emb.get_chunk_objects(paragraphs) # Add vector field
+
+        if push: # straight into the index, no blobs and no indexer
+            # the container is left as it was, the next incremental run re-seeds from the index and the container
+            IndexManifest(index.index_name).delete()
+
+            print("\nDeleting search index if it exists...")
+            index.delete_index_if_exists()
+
+            print("\nCreating new search index...")
+            index.create_search_index()
 
-    print("\nLoading data into the container...")
-    stor.upload_to_container(paragraphs)
+            print("\nUploading chunks into the search index...")
+            index.upload_to_index(paragraphs)
+
+            if use_vector:
+                emb.close()
+
+            if blue_green:
+                promote_index(index, expected_count=len(paragraphs))
+
+            print("\nFinished.")
+            return
+
+        prepare_index(index, stor)
+
+        print("\nLoading data into the container...")
+        manifest, hashes, blobs = IndexManifest(index.index_name), {}, {}
+        summary = stor.upload_to_container(iter_recorded(paragraphs, manifest, hashes, blobs, stor.title_field))
+        save_manifest(index, stor, manifest, hashes, blobs, summary["failed_names"])
     
+    if use_vector:
+        print(f"\nEmbedding cache: {emb.cache.stats()}")
+        print(f"Embedding requests: {emb.scheduler.stats()}") # achieved TPM against the deployment quota
+        emb.close()
+
     print("\nCreating new indexer...")
     indexer.build_indexer()
 
+    if wait or blue_green:
+        print("\nWaiting for the indexer...")
+        run = indexer.wait_for_completion(expected_items=None if stream else len(paragraphs))
+
+        if blue_green and run["status"] != "success":
+            discard_version(index, indexer)
+        assert run["status"] == "success", f"Indexer run ended with status '{run['status']}': {run['errors'][:5]}"
+
+    if blue_green:
+        promote_index(index, expected_count=len(paragraphs), indexer=indexer)
+
     print("\nFinished.")
 
 
@@ -65,9 +294,19 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-ni", "--no-image", action="store_true", help="not extract images")
     parser.add_argument("-nv", "--no-vector", action="store_true", help="not create embeddings")
+    parser.add_argument("-l", "--layout", action="store_true", help="analyze the splits (only new or changed ones) instead of loading the pickle")
+    parser.add_argument("-p", "--parquet", action="store_true", help="load (or, with --layout, export) the columnar layout instead of the pickle")
+    parser.add_argument("-s", "--stream", action="store_true", help="stream chunks through format, embed and upload stages")
+    parser.add_argument("-i", "--incremental", "-u", "--upsert", dest="incremental", action="store_true", help="diff the chunks against the manifest of the last run: upload only added or changed ones, delete removed ones, keep the index if its schema is unchanged")
+    parser.add_argument("-P", "--push", action="store_true", help="upload the chunks in batches straight into the index instead of the container and indexer")
+    parser.add_argument("-bg", "--blue-green", action="store_true", help="build a new index version, then swap it in once complete (queries never see a partial index)")
+    parser.add_argument("-w", "--wait", action="store_true", help="block until the indexer run completes, reporting its progress")
+    parser.add_argument("-pk", "--pack-size", type=int, default=0, help="chunks per json-lines blob (up to 8 MB), 0 for one json blob per chunk (default: 0)")
+    parser.add_argument("-ct", "--chunk-tokens", type=int, default=512, help="token budget of each chunk, 0 to merge paragraphs by header (default: 512)")
+    parser.add_argument("-co", "--chunk-overlap", type=int, default=64, help="tokens repeated between consecutive chunks of a section (default: 64)")
     args = parser.parse_args()
 
     use_image = not args.no_image
     use_vector = not args.no_vector
 
-    create_index(use_image=use_image, use_vector=use_vector)
+    create_index(use_image=use_image, use_vector=use_vector, use_layout=args.layout, use_parquet=args.parquet, stream=args.stream, incremental=args.incremental, push=args.push, blue_green=args.blue_green, wait=args.wait, pack_size=args.pack_size, chunk_tokens=args.chunk_tokens, chunk_overlap=args.chunk_overlap)
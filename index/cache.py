@@ -0,0 +1,121 @@
+import os
+import json
+import time
+import hashlib
+
+from azure.ai.documentintelligence.models import AnalyzeResult
+
+
+class LayoutCache():
+    """
+        Content-addressed cache of layout results, one json entry per split
+    """
+
+    def __init__(self, cache_dir: str = "data/layout_cache", model_id: str = "prebuilt-layout"):
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.cache_dir = cache_dir
+        self.model_id = model_id
+        self.manifest_path = os.path.join(cache_dir, "manifest.json")
+
+    def file_digest(self, path):
+        sha = hashlib.sha256()
+
+        with open(path, "rb") as fin:
+            for block in iter(lambda: fin.read(1 << 20), b""):
+                sha.update(block)
+
+        return sha.hexdigest()
+
+    def get_key(self, pdf_path, json_path):
+        key = "\n".join([self.model_id, self.file_digest(pdf_path), self.file_digest(json_path)])
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def load_manifest(self):
+        if not os.path.isfile(self.manifest_path):
+            return {}
+
+        with open(self.manifest_path, "r") as fin:
+            return json.load(fin)
+
+    def save_manifest(self, manifest):
+        self.write_atomic(self.manifest_path, manifest)
+
+    def write_atomic(self, path, obj):
+        tmp_path = path + ".tmp"
+
+        with open(tmp_path, "w") as fout:
+            json.dump(obj, fout)
+
+        os.replace(tmp_path, path)
+
+    def get(self, key):
+        path = self.entry_path(key)
+
+        if not os.path.isfile(path):
+            return None
+
+        with open(path, "r") as fin:
+            entry = json.load(fin)
+
+        return AnalyzeResult(entry["result"])
+
+    def put(self, key, split_name, result):
+        entry = {"key": key, "split": split_name, "model_id": self.model_id, "result": result.as_dict()}
+        self.write_atomic(self.entry_path(key), entry)
+
+        manifest = self.load_manifest()
+        manifest[key] = {
+            "split": split_name,
+            "model_id": self.model_id,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "size": os.path.getsize(self.entry_path(key))
+            }
+        self.save_manifest(manifest)
+
+    def entries(self):
+        return [{"key": key, **meta} for key, meta in self.load_manifest().items()]
+
+    def prune(self, keep_keys):
+        """
+            Remove every entry whose key is not in keep_keys, returns the removed keys
+        """
+        keep_keys = set(keep_keys)
+        manifest = self.load_manifest()
+
+        removed = [key for key in manifest if key not in keep_keys]
+
+        for key in removed:
+            manifest.pop(key)
+
+            if os.path.isfile(self.entry_path(key)):
+                os.remove(self.entry_path(key))
+
+        self.save_manifest(manifest)
+
+        return removed
+
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--cache-dir", type=str, default="data/layout_cache", help="cache directory (default: 'data/layout_cache')")
+    parser.add_argument("-p", "--prune", type=str, default=None, help="remove the entries not matching the splits of this pdf root")
+    args = parser.parse_args()
+
+    cache = LayoutCache(cache_dir=args.cache_dir)
+
+    if args.prune:
+        from index.document import DocumentProcessor
+
+        doc = DocumentProcessor(root_path=args.prune, use_images=False)
+        removed = cache.prune([key for key, _, _ in doc.get_split_keys(cache)])
+        print(f"Removed {len(removed)} entries.")
+
+    for entry in cache.entries():
+        print(f"{entry['key'][:12]}  {entry['split']}  {entry['model_id']}  {entry['created']}  {entry['size']} bytes")
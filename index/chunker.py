@@ -0,0 +1,147 @@
+import re
+import math
+
+from typing import List, Tuple, Dict
+
+import tiktoken
+
+
+SENTENCE_END_RE = re.compile(r'(?<=[.!?])\s+')
+
+
+class Chunker():
+    """
+        Pack sections into token-budgeted chunks of roughly uniform size
+    """
+
+    def __init__(self, max_tokens: int = 512, overlap_tokens: int = 64, min_words: int = 3, encoding_name: str = "cl100k_base"):
+        assert 0 <= overlap_tokens < max_tokens
+
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+        self.min_words = min_words
+
+        self.tokenizer = tiktoken.get_encoding(encoding_name=encoding_name)
+
+    def count(self, text: str) -> int:
+        return len(self.tokenizer.encode(text, disallowed_special=()))
+
+    def clean(self, text: str) -> str:
+        # drop short lines (page numbers, captions, list bullets...)
+        return "\n".join([x.strip() for x in text.split("\n") if len(x.strip().split()) >= self.min_words])
+
+    def split_hard(self, text: str, max_tokens: int) -> List[str]:
+        tokens = self.tokenizer.encode(text, disallowed_special=())
+        return [self.tokenizer.decode(tokens[i:i+max_tokens]) for i in range(0, len(tokens), max_tokens)]
+
+    def split_unit(self, text: str, max_tokens: int) -> List[Tuple[str, int, str]]:
+        """
+            Split a paragraph over the budget at sentence boundaries (hard token split as last resort).
+            Returns (piece, tokens, whitespace that preceded the piece in the paragraph).
+        """
+        n_tokens = self.count(text)
+
+        if n_tokens <= max_tokens:
+            return [(text, n_tokens, "")]
+
+        pieces = []
+
+        start, prefix = 0, ""
+        for boundary in list(SENTENCE_END_RE.finditer(text)) + [None]:
+            sentence = text[start:boundary.start()] if boundary else text[start:]
+
+            if sentence.strip():
+                n_tokens = self.count(sentence)
+
+                if n_tokens <= max_tokens:
+                    pieces.append((sentence, n_tokens, prefix))
+                else:
+                    # token slices are contiguous, nothing in between
+                    pieces.extend((x, self.count(x), prefix if i == 0 else "") for i, x in enumerate(self.split_hard(sentence, max_tokens)))
+
+            if boundary:
+                start, prefix = boundary.end(), boundary.group()
+
+        if pieces:
+            pieces[0] = pieces[0][:2] + ("",)
+
+        return pieces
+
+    def join(self, pieces: List[Tuple], separator: str) -> str:
+        # separator between paragraphs, the original whitespace between pieces of the same paragraph
+        text = pieces[0][0]
+        for previous, piece in zip(pieces, pieces[1:]):
+            text += (piece[4] if piece[3] == previous[3] else separator) + piece[0]
+        return text
+
+    def pack(self, units: List[Tuple[str, object]], separator: str = "\n", max_tokens: int = None, overlap: bool = True) -> List[Tuple[str, object]]:
+        """
+            Greedily pack (text, meta) units into chunks, returns (text, meta of the first unit) per chunk.
+            The budget is spread evenly across chunks and, with overlap, trailing pieces of a chunk are repeated at the start of the next one.
+        """
+        max_tokens = max_tokens or self.max_tokens
+        overlap_tokens = self.overlap_tokens if overlap else 0
+
+        # (text, tokens, meta, unit index, whitespace before the piece within its unit)
+        pieces = [(text, n_tokens, meta, unit_idx, prefix) for unit_idx, (unit, meta) in enumerate(units) for text, n_tokens, prefix in self.split_unit(unit, max_tokens)]
+
+        if not pieces:
+            return []
+
+        sep_tokens = self.count(separator) if separator else 0
+
+        total_tokens = sum(piece[1] for piece in pieces) + sep_tokens * (len(pieces) - 1)
+        target_tokens = math.ceil(total_tokens / math.ceil(total_tokens / max_tokens))
+
+        chunks = []
+        current, current_tokens, carried = [], 0, 0
+
+        for piece in pieces:
+            n_tokens = piece[1]
+            new_tokens = current_tokens + (sep_tokens if current else 0) + n_tokens
+
+            if len(current) > carried and (new_tokens > max_tokens or current_tokens >= target_tokens):
+                chunks.append((current, carried))
+
+                # carry the tail of the chunk as overlap, if it still leaves room for the next piece
+                tail, tail_tokens = [], 0
+                for previous in reversed(current):
+                    if tail_tokens + previous[1] > overlap_tokens or tail_tokens + previous[1] + sep_tokens + n_tokens > max_tokens:
+                        break
+                    tail.insert(0, previous)
+                    tail_tokens += previous[1] + sep_tokens
+
+                current, current_tokens, carried = tail, tail_tokens, len(tail)
+                new_tokens = current_tokens + n_tokens
+
+            current.append(piece)
+            current_tokens = new_tokens
+
+        if len(current) > carried:
+            chunks.append((current, carried))
+
+        # meta of the first piece that is not overlap
+        return [(self.join(chunk, separator), chunk[carried][2]) for chunk, carried in chunks]
+
+    def split_table(self, table: Dict) -> List[Tuple[str, str]]:
+        """
+            Keep a table whole if it fits, else split it in row groups repeating the first (header) row.
+            Returns (content, header suffix) pairs.
+        """
+        if self.count(table["content"]) <= self.max_tokens or len(table["rows"]) < 2:
+            return [(table["content"], "")]
+
+        header_row, rows = table["rows"][0], table["rows"][1:]
+        budget = self.max_tokens - self.count(header_row)
+
+        if budget <= 0: # header row alone is over budget, split the table as plain text
+            return [(content, f" (part {i+1})") for i, (content, _) in enumerate(self.pack([(row, None) for row in table["rows"]], separator="", overlap=False))]
+
+        groups = self.pack([(row, i+1) for i, row in enumerate(rows)], separator="", max_tokens=budget, overlap=False)
+
+        splits = []
+        for i, (content, first_row) in enumerate(groups):
+            last_row = max(first_row, groups[i+1][1] - 1) if i+1 < len(groups) else len(rows)
+            splits.append((header_row + content, f" (rows {first_row}-{last_row})"))
+
+        return splits
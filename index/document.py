@@ -1,22 +1,19 @@
 import os
 import glob
-import uuid
-from dotenv import load_dotenv, find_dotenv
-load_dotenv(find_dotenv())
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils.env import load_env
+load_env()
 
 from azure.core.credentials import AzureKeyCredential
 from azure.ai.documentintelligence import DocumentIntelligenceClient
 from azure.ai.documentintelligence.models import ParagraphRole
 
-from agents.image_agents import compile_graph, draw_mermaid
-
-import re
-
-import nltk
-nltk.download('wordnet', quiet=True)
-nltk.download('stopwords', quiet=True)
-from nltk.corpus import stopwords
-from nltk.stem import WordNetLemmatizer
+from index.cache import LayoutCache
+from index.spans import SpanIndex
+from index.chunker import Chunker
+from index.normalizer import TextNormalizer
 
 import json
 import pickle
@@ -27,7 +24,7 @@ class DocumentProcessor():
         Scan and format information from pdfs
     """
 
-    def __init__(self, root_path: str, splits_dir: str = "splits", images_dir: str = "images", use_images = True):
+    def __init__(self, root_path: str, splits_dir: str = "splits", images_dir: str = "images", use_images = True, normalize_workers: int = None, chunker: Chunker = None):
         splits_path = os.path.join(root_path, splits_dir)
         assert os.path.isdir(splits_path)
 
@@ -45,6 +42,16 @@ class DocumentProcessor():
         self.document_endpoint = os.getenv("DOCUMENT_ENDPOINT")
         self.document_api_key = os.getenv("DOCUMENT_API_KEY")
 
+        self.normalizer = None
+        self.normalize_workers = normalize_workers
+
+        self.chunker = chunker
+
+    def get_normalizer(self):
+        if not self.normalizer:
+            self.normalizer = TextNormalizer()
+        return self.normalizer
+
     def get_document_client(self):
         document_intelligence_client = DocumentIntelligenceClient(
             endpoint=self.document_endpoint, credential=AzureKeyCredential(self.document_api_key)
@@ -57,7 +64,7 @@ class DocumentProcessor():
 
         # images_results = None
         # if self.use_images:
-        #     images_results = self.get_images()
+        #     images_results, _ = self.get_images()
         
         # results = {"documents": result["documents"], "images": images_results}
 
@@ -67,23 +74,70 @@ class DocumentProcessor():
         #         pickle.dump(results, fout)   
 
         return result
+
+    def create_from_parquet(self, path_to_dir):
+        from index.layout_store import LayoutStore # pyarrow is only needed here
+
+        return LayoutStore(path_to_dir).load()
+
+    def export_to_parquet(self, result, path_to_dir):
+        from index.layout_store import LayoutStore
+
+        LayoutStore(path_to_dir).export(result)
     
-    def get_images(self):
+    def get_images(self, max_concurrency: int = 4, verbose=True):
+        """
+            Run the image description graph over all images, up to max_concurrency at a time.
+            Returns (results, failures), failures being {"image", "error"} for the images to retry.
+        """
+        from agents.image_agents import compile_graph # langgraph and chat clients are only needed here
+
         image_workflow = compile_graph()
-        draw_mermaid()
 
-        results = []
+        image_paths = [os.path.join(self.images_path, image) for image in sorted(os.listdir(self.images_path))]
 
-        for image in os.listdir(self.images_path):
-            image_path = os.path.join(self.images_path, image)
-            result = image_workflow.invoke({"image": image_path})
-            results.append(result)
+        start = time.perf_counter()
 
-        return results
+        outputs = image_workflow.batch([{"image": image_path} for image_path in image_paths], 
+                                       config={"max_concurrency": max_concurrency}, 
+                                       return_exceptions=True)
+
+        results, failures = [], []
+
+        for image_path, output in zip(image_paths, outputs):
+            if isinstance(output, Exception):
+                failures.append({"image": image_path, "error": f"{type(output).__name__}: {output}"})
+            else:
+                results.append(output)
+
+        if verbose:
+            print(f"   {len(results)} images described in {time.perf_counter() - start:.2f}s, {len(failures)} failed")
+            for failure in failures:
+                print(f"      Could not describe {failure['image']} ({failure['error']})")
+
+        return results, failures
+
+    def analyze_split(self, document_intelligence_client, pdf_name, json_name):
+        pdf_path = os.path.join(self.splits_path, pdf_name)
+        json_path = os.path.join(self.splits_path, json_name)
+
+        start = time.perf_counter()
+
+        with open(pdf_path, "rb") as pdf_file:
+            poller = document_intelligence_client.begin_analyze_document(
+                "prebuilt-layout", body=pdf_file
+            )
 
-    def create_from_layout(self, save_to_file="results.pkl", verbose=True):
-        document_intelligence_client = self.get_document_client()
+            result = poller.result()
+
+        latency = time.perf_counter() - start
+
+        with open(json_path, "r") as json_file:
+            json_file = json.load(json_file)
 
+        return {**json_file, "result": result}, latency
+
+    def get_split_files(self):
         pdf_files = glob.glob("*.pdf", root_dir=self.splits_path)
         json_files = glob.glob("*.json", root_dir=self.splits_path)
 
@@ -92,40 +146,81 @@ class DocumentProcessor():
 
         assert len(pdf_files) == len(json_files)
 
-        results = []
+        return list(zip(pdf_files, json_files))
+
+    def get_split_keys(self, cache: LayoutCache):
+        return [(cache.get_key(os.path.join(self.splits_path, pdf_name), os.path.join(self.splits_path, json_name)), pdf_name, json_name)
+                for pdf_name, json_name in self.get_split_files()]
+
+    def create_from_layout(self, save_to_file="results.pkl", max_concurrency: int = 4, cache_dir: str = None, verbose=True):
+        """
+            Analyze the splits with up to max_concurrency pollers in flight, results keep the splits order.
+            With cache_dir, only the splits missing from the layout cache are sent to Document Intelligence.
+        """
+        assert max_concurrency >= 1
+
+        cache = LayoutCache(cache_dir=cache_dir) if cache_dir else None
+
+        if cache:
+            split_keys = self.get_split_keys(cache)
+        else:
+            split_keys = [(None, pdf_name, json_name) for pdf_name, json_name in self.get_split_files()]
+
+        results = [None] * len(split_keys)
+        to_analyze = []
+
+        for i, (key, pdf_name, json_name) in enumerate(split_keys):
+            result = cache.get(key) if cache else None
+
+            if result is None:
+                to_analyze.append(i)
+                continue
+
+            with open(os.path.join(self.splits_path, json_name), "r") as json_file:
+                json_file = json.load(json_file)
+
+            results[i] = {**json_file, "result": result}
 
         if verbose:
             print("   Reading documents...")
+            if cache:
+                print(f"   {len(split_keys) - len(to_analyze)} splits found in cache, {len(to_analyze)} to analyze")
 
-        for pdf_name, json_name in zip(pdf_files, json_files):
-            pdf_path = os.path.join(self.splits_path, pdf_name)
-            json_path = os.path.join(self.splits_path, json_name)
+        start = time.perf_counter()
 
-            pdf_file = open(pdf_path, "rb")
+        if to_analyze:
+            document_intelligence_client = self.get_document_client()
 
-            poller = document_intelligence_client.begin_analyze_document(
-                "prebuilt-layout", body=pdf_file
-            )
+            try:
+                with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+                    futures = [executor.submit(self.analyze_split, document_intelligence_client, *split_keys[i][1:]) for i in to_analyze]
 
-            result = poller.result()
+                    for i, future in zip(to_analyze, futures):
+                        key, pdf_name, _ = split_keys[i]
 
-            with open(json_path, "r") as json_file:
-                json_file = json.load(json_file)
+                        result, latency = future.result()
+                        results[i] = result
+
+                        if cache:
+                            cache.put(key, pdf_name, result["result"])
 
-            results.append({
-                **json_file,
-                "result": result
-                })
+                        if verbose:
+                            print(f"      {pdf_name} analyzed in {latency:.2f}s")
+            finally:
+                document_intelligence_client.close()
 
-        document_intelligence_client.close() # add try-except
+        elapsed = time.perf_counter() - start
 
-        images_results = None
+        if verbose and to_analyze:
+            print(f"   {len(to_analyze)} splits analyzed in {elapsed:.2f}s ({len(to_analyze) / elapsed:.2f} splits/s)")
+
+        images_results, images_failures = None, []
         if self.use_images:
             if verbose:
                 print("   Reading images...")
-            images_results = self.get_images()
+            images_results, images_failures = self.get_images(max_concurrency=max_concurrency, verbose=verbose)
         
-        results = {"documents": results, "images": images_results}
+        results = {"documents": results, "images": images_results, "image_failures": images_failures}
 
         if save_to_file:
             with open(save_to_file, "wb") as fout:
@@ -151,6 +246,7 @@ class DocumentProcessor():
                 print(header)
 
             content = ""
+            rows = {}
                 
             for cell in table.cells:
                 cell_to_string = "Cell[{}][{}]: {}".format(
@@ -163,31 +259,59 @@ class DocumentProcessor():
                     print(cell_to_string)
                 
                 content += " " + cell_to_string
+                rows[cell.row_index] = rows.get(cell.row_index, "") + " " + cell_to_string
             
-            tables.append({"header":header, "content":content})
+            tables.append({"header":header, "content":content, "rows":[rows[r] for r in sorted(rows)]})
 
-        return tables, spans
+        return tables, SpanIndex(spans)
 
     def normalize_text(self, text):
-        format_text = text.strip().lower()
-        format_text = re.sub(r'\d+','',format_text)
-        format_text = re.sub(r'[^\w\s]','',format_text)
+        return self.get_normalizer().normalize(text)
+
+    def normalize_texts(self, texts):
+        return self.get_normalizer().normalize_many(texts, workers=self.normalize_workers)
 
-        lemmmatizer = WordNetLemmatizer()
-        words = [lemmmatizer.lemmatize(word) for word in format_text.split() if word not in set(stopwords.words('english'))]
-        format_text = ' '.join(words)
+    def get_chunk_id(self, paragraph):
+        content_hash = hashlib.sha256(paragraph["raw_content"].encode("utf-8")).hexdigest()
+        key = "\n".join([str(paragraph["source"]), str(paragraph["page"]), str(paragraph["header"]), content_hash])
 
-        return format_text
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+
+    def assign_ids(self, paragraphs, seen_ids: set = None):
+        """
+            Deterministic ids from source, page, header and content hash, so rebuilds produce the same keys
+        """
+        seen_ids = set() if seen_ids is None else seen_ids
+
+        identified = []
+
+        for paragraph in paragraphs:
+            chunk_id = self.get_chunk_id(paragraph)
+
+            # identical chunks get a numbered suffix
+            unique_id, n = chunk_id, 1
+            while unique_id in seen_ids:
+                unique_id = f"{chunk_id}-{n}"
+                n += 1
+
+            seen_ids.add(unique_id)
+            identified.append({"id": unique_id, **{k: v for k, v in paragraph.items() if k != "id"}})
+
+        return identified
 
     def format_paragraphs(self, analyze_result, add_id: bool = True):
+        if self.chunker:
+            return self.format_chunks(analyze_result, add_id=add_id)
+
         file_name = analyze_result["file_name"]
         split_offset = analyze_result["split_offset"]
         result = analyze_result["result"]
         url = analyze_result["url"]
 
-        tables, tables_spans = self.get_tables(result)
+        tables, tables_index = self.get_tables(result)
 
         formatted_paragraphs = []
+        to_normalize = {} # paragraph position -> raw pieces, normalized in one batch at the end
 
         header = None
 
@@ -196,10 +320,8 @@ class DocumentProcessor():
                 for region in paragraph.bounding_regions:
                     
                     # check if paragraph is/contains a table
-                    table = None
-                    for t, s in zip(tables, tables_spans):
-                        if s["offset"] <= span["offset"] <= (s["offset"]+s["length"]):
-                            table = t
+                    table_idx = tables_index.find(span["offset"])
+                    table = tables[table_idx] if table_idx is not None else None
 
                     # if table, check if not already in results
                     if table and (not formatted_paragraphs or table["content"] != formatted_paragraphs[-1]["raw_content"]):
@@ -207,10 +329,7 @@ class DocumentProcessor():
                         content = table["content"]
                         page_num = int(region.page_number) + int(split_offset) - 1
 
-                        form_par = {"id": str(uuid.uuid4())} if add_id else {}
-
                         formatted_paragraphs.append({
-                            **form_par,
                             "header":table_header,
                             "raw_content":content,
                             "format_content":content,
@@ -230,31 +349,120 @@ class DocumentProcessor():
 
                         page_num = int(region.page_number) + int(split_offset) - 1
 
-                        format_content = self.normalize_text(content)   
-
                         if content.strip() != "":                     
                             if formatted_paragraphs and header == formatted_paragraphs[-1]["header"]:
                                 # append to existing paragraph
                                 formatted_paragraphs[-1]["raw_content"] += "\n" + content
-                                formatted_paragraphs[-1]["format_content"] += " " + format_content
+                                to_normalize.setdefault(len(formatted_paragraphs)-1, []).append(content)
                             else:
-                                form_par = {"id": str(uuid.uuid4())} if add_id else {}
-                                
                                 formatted_paragraphs.append({
-                                    **form_par,
                                     "header":header,
                                     "raw_content":content,
-                                    "format_content":format_content,
+                                    "format_content":None,
                                     "page":page_num,
                                     "source":file_name,
                                     "url":url})
+                                to_normalize[len(formatted_paragraphs)-1] = [content]
+
+        normalized = iter(self.normalize_texts([piece for pieces in to_normalize.values() for piece in pieces]))
+
+        for idx, pieces in to_normalize.items():
+            format_contents = [next(normalized) for _ in pieces]
+
+            if formatted_paragraphs[idx]["format_content"] is not None: # table followed by text with the same header
+                format_contents.insert(0, formatted_paragraphs[idx]["format_content"])
+
+            formatted_paragraphs[idx]["format_content"] = " ".join(format_contents)
+
+        if add_id:
+            formatted_paragraphs = self.assign_ids(formatted_paragraphs)
+
+        return formatted_paragraphs
+
+    def format_chunks(self, analyze_result, add_id: bool = True):
+        """
+            Token-budgeted alternative to format_paragraphs: sections (text under the same header, or a table)
+            are split by the chunker instead of being merged into one chunk
+        """
+        file_name = analyze_result["file_name"]
+        split_offset = analyze_result["split_offset"]
+        result = analyze_result["result"]
+        url = analyze_result["url"]
+
+        tables, tables_index = self.get_tables(result)
+
+        sections = []
+
+        header = None
+        last_table_idx = None
+
+        for paragraph in result.paragraphs:
+            page_num = int(paragraph.bounding_regions[0].page_number) + int(split_offset) - 1
+
+            # check if paragraph is/contains a table
+            table_idx = next((idx for idx in (tables_index.find(span["offset"]) for span in paragraph.spans) if idx is not None), None)
+
+            if table_idx is not None:
+                if table_idx != last_table_idx:
+                    sections.append({"header": tables[table_idx]["header"], "table": tables[table_idx], "page": page_num})
+                    last_table_idx = table_idx
+                continue
+
+            role = paragraph.role
+
+            if role:
+                if role in [ParagraphRole.TITLE, ParagraphRole.SECTION_HEADING]:
+                    header = paragraph.content
+                continue
+
+            content = self.chunker.clean(paragraph.content)
+
+            if content.strip() == "":
+                continue
+
+            if sections and not sections[-1].get("table") and sections[-1]["header"] == header:
+                sections[-1]["units"].append((content, page_num))
+            else:
+                sections.append({"header": header, "units": [(content, page_num)]})
+
+        formatted_paragraphs = []
+
+        for section in sections:
+            if section.get("table"):
+                for content, suffix in self.chunker.split_table(section["table"]):
+                    formatted_paragraphs.append({
+                        "header":section["header"] + suffix,
+                        "raw_content":content,
+                        "format_content":content,
+                        "page":section["page"],
+                        "source":file_name,
+                        "url":url})
+            else:
+                for content, page_num in self.chunker.pack(section["units"]):
+                    formatted_paragraphs.append({
+                        "header":section["header"],
+                        "raw_content":content,
+                        "format_content":None,
+                        "page":page_num,
+                        "source":file_name,
+                        "url":url})
+
+        to_normalize = [par for par in formatted_paragraphs if par["format_content"] is None]
+
+        for par, format_content in zip(to_normalize, self.normalize_texts([par["raw_content"] for par in to_normalize])):
+            par["format_content"] = format_content
+
+        if add_id:
+            formatted_paragraphs = self.assign_ids(formatted_paragraphs)
 
         return formatted_paragraphs
 
     def format_images(self, analyze_result, add_id: bool = True):
         formatted_images = []
 
-        for res in analyze_result:
+        format_contents = self.normalize_texts([res["result"].description for res in analyze_result])
+
+        for res, format_content in zip(analyze_result, format_contents):
             image_path = res["image"]
             image_name = os.path.basename(image_path)
 
@@ -262,13 +470,8 @@ class DocumentProcessor():
 
             header = "Image: " + res.title
             content = res.description
-            format_content = self.normalize_text(content)
 
-            form_par = {"id": str(uuid.uuid4())} if add_id else {}
-                        
             formatted_images.append([{
-                **form_par,
-                "id": str(uuid.uuid4()),
                 "header": header,
                 "raw_content": content,
                 "format_content": format_content,
@@ -277,6 +480,9 @@ class DocumentProcessor():
                 "url": None
                 }
             ])
+
+        if add_id:
+            formatted_images = [self.assign_ids(res) for res in formatted_images]
         
         return formatted_images
     
@@ -315,4 +521,14 @@ class DocumentProcessor():
             formatted_results = self.flatten_result(formatted_results)
 
         return formatted_results
-    
\ No newline at end of file
+
+    def iter_result(self, analyze_result):
+        """
+            Lazy, flattened version of format_result: yields one paragraph at a time
+        """
+        for doc_res in analyze_result["documents"]:
+            yield from self.format_paragraphs(doc_res)
+
+        if self.use_images and analyze_result["images"]:
+            for image_res in self.format_images(analyze_result["images"]):
+                yield from image_res
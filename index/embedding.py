@@ -1,58 +1,217 @@
 import os
-from dotenv import load_dotenv, find_dotenv
-load_dotenv(find_dotenv())
+import asyncio
+import threading
+from utils.env import load_env
+load_env()
 
 from azure.core.credentials import AzureKeyCredential
-from azure.ai.inference import EmbeddingsClient
+from azure.ai.inference.aio import EmbeddingsClient
 
-from typing import List, Dict
+from typing import List, Dict, Tuple, Iterable, Iterator
+from itertools import islice
 
+import numpy as np
 import tiktoken
 
+from utils.embedding_cache import EmbeddingCache
+from index.scheduler import EmbeddingScheduler
+
 
 class Embedder():
     """
         Embed text into vector space
     """
 
-    def __init__(self, format_content_field: str = "format_content"):
+    def __init__(self, format_content_field: str = "format_content", max_batch_inputs: int = 256, max_batch_tokens: int = 64_000, cache: EmbeddingCache = None, scheduler: EmbeddingScheduler = None):
         self.endpoint = os.getenv("EMBEDDING_ENDPOINT")
         self.api_key = os.getenv("OPENAI_API_KEY")
         self.model_deployment = os.getenv("EMBEDDING_DEPLOYMENT")
+        self.dimensions = int(os.getenv("EMBEDDING_DIMENSIONS")) if os.getenv("EMBEDDING_DIMENSIONS") else None # text-embedding-3 models only
 
         self.format_content_field = format_content_field
 
-    def get_client(self):
-        client = EmbeddingsClient(
-            endpoint=self.endpoint,
-            credential=AzureKeyCredential(self.api_key)
+        self.max_batch_inputs = max_batch_inputs
+        self.max_batch_tokens = max_batch_tokens
+
+        self.client = None
+        self.loop = None
+        self.loop_thread = None
+        self.tokenizer = None
+        self.cache = cache
+
+        # quota of the deployment, e.g. EMBEDDING_RPM=720 and EMBEDDING_TPM=120000 (unbounded if not set)
+        self.scheduler = scheduler or EmbeddingScheduler(
+            rpm=int(os.getenv("EMBEDDING_RPM")) if os.getenv("EMBEDDING_RPM") else None,
+            tpm=int(os.getenv("EMBEDDING_TPM")) if os.getenv("EMBEDDING_TPM") else None,
+            max_in_flight=int(os.getenv("EMBEDDING_MAX_IN_FLIGHT", 8))
         )
-        return client
-    
+
+    def get_loop(self):
+        # one event loop in a background thread for the life of the Embedder,
+        # so that the async client (and its connection pool) outlives each embed_many call
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            self.loop_thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+            self.loop_thread.start()
+        return self.loop
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.get_loop()).result()
+
+    def get_client(self):
+        # one client (and connection pool) reused by all requests, see close()
+        if self.client is None:
+            self.client = EmbeddingsClient(
+                endpoint=self.endpoint,
+                credential=AzureKeyCredential(self.api_key)
+            )
+        return self.client
+
+    def close(self):
+        if self.client is not None:
+            self.run(self.client.close())
+            self.client = None
+
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop_thread.join()
+            self.loop.close()
+            self.loop, self.loop_thread = None, None
+
+        if self.cache:
+            self.cache.close()
+
+    def get_tokenizer(self):
+        if self.tokenizer is None:
+            self.tokenizer = tiktoken.get_encoding(encoding_name="cl100k_base")
+        return self.tokenizer
+
+    def count_tokens(self, texts: List[str], num_threads: int = 8) -> np.ndarray:
+        return np.fromiter((len(x) for x in self.get_tokenizer().encode_batch(texts, num_threads=num_threads, disallowed_special=())), dtype=np.int64, count=len(texts))
+
+    def token_profile(self, paragraphs: List[Dict], max_tokens: int = 1000, num_threads: int = 8) -> Dict:
+        """
+            Token counts per chunk, their distribution, the chunks over max_tokens and the estimated embedding cost and time.
+            Cost needs EMBEDDING_PRICE_PER_1M_TOKENS, time the scheduler's TPM/RPM.
+        """
+        counts = self.count_tokens([p[self.format_content_field] for p in paragraphs], num_threads=num_threads)
+
+        total = int(counts.sum())
+        n_requests = sum(1 for _ in self.get_batches_from_counts(counts))
+
+        price = os.getenv("EMBEDDING_PRICE_PER_1M_TOKENS")
+
+        minutes = [x for x in (total / self.scheduler.tpm if self.scheduler.tpm else None,
+                               n_requests / self.scheduler.rpm if self.scheduler.rpm else None) if x is not None]
+
+        return {"counts": counts,
+                "chunks": len(counts),
+                "total": total,
+                "p50": float(np.percentile(counts, 50)) if len(counts) else 0.0,
+                "p95": float(np.percentile(counts, 95)) if len(counts) else 0.0,
+                "max": int(counts.max()) if len(counts) else 0,
+                "over": [paragraphs[i].get("id", paragraphs[i].get("header")) for i in np.flatnonzero(counts > max_tokens)],
+                "requests": n_requests,
+                "cost": total / 1e6 * float(price) if price else None,
+                "minutes": max(minutes) if minutes else None}
+
     def tokens_number_test(self, paragraphs: List[Dict], max_tokens=1000):
-        tokenizer = tiktoken.get_encoding(encoding_name="cl100k_base")
-        tokens = [len(tokenizer.encode(p[self.format_content_field], disallowed_special=())) > max_tokens for p in paragraphs]
+        return "succeded" if not self.token_profile(paragraphs, max_tokens=max_tokens)["over"] else "failed"
+
+    def check_tokens(self, paragraphs: Iterable[Dict], max_tokens=1000) -> Iterator[Dict]:
+        """
+            Streaming version of tokens_number_test, raises on the first paragraph over max_tokens
+        """
+        tokenizer = self.get_tokenizer()
+
+        for p in paragraphs:
+            if len(tokenizer.encode(p[self.format_content_field], disallowed_special=())) > max_tokens:
+                raise ValueError(f"Paragraph '{p.get('header')}' has more than {max_tokens} tokens")
+            yield p
 
-        return "succeded" if not any(tokens) else "failed"
+    def get_batches(self, texts: List[str]) -> Iterator[Tuple[List[int], int]]:
+        """
+            Group text positions into requests bounded by number of inputs and total tokens, yields (positions, tokens)
+        """
+        yield from self.get_batches_from_counts(self.count_tokens(texts))
+
+    def get_batches_from_counts(self, counts: Iterable[int]) -> Iterator[Tuple[List[int], int]]:
+        batch, batch_tokens = [], 0
+
+        for i, n_tokens in enumerate(int(x) for x in counts):
+            if batch and (len(batch) >= self.max_batch_inputs or batch_tokens + n_tokens > self.max_batch_tokens):
+                yield batch, batch_tokens
+                batch, batch_tokens = [], 0
+
+            batch.append(i)
+            batch_tokens += n_tokens
+
+        if batch:
+            yield batch, batch_tokens
+
+    def get_embed_kwargs(self, texts: List[str]) -> Dict:
+        kwargs = {"input": texts, "model": self.model_deployment}
+        if self.dimensions:
+            kwargs["dimensions"] = self.dimensions
+        return kwargs
+
+    async def embed_batches(self, batches: List[Tuple[List[str], int]]) -> List[List[List[float]]]:
+        """
+            Embed (texts, tokens) batches concurrently through the rate-limited scheduler.
+            Vectors are cached as soon as their request completes, so an interrupted run does not lose them.
+        """
+        client = self.get_client()
+
+        async def embed(texts):
+            response = await client.embed(**self.get_embed_kwargs(texts))
+            vectors = [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+            if self.cache:
+                self.cache.set_many(self.model_deployment, self.dimensions, texts, vectors)
+
+            return vectors
+
+        return await self.scheduler.run([(lambda texts=texts: embed(texts), n_tokens) for texts, n_tokens in batches])
+
+    def embed_many(self, texts: List[str]) -> List[List[float]]:
+        """
+            Embed texts with as few requests as possible, vectors are returned in input order
+        """
+        texts = list(texts)
+
+        if self.cache:
+            vectors = self.cache.get_many(self.model_deployment, self.dimensions, texts)
+        else:
+            vectors = [None] * len(texts)
+
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+
+        if not missing:
+            return vectors
+
+        batches = [([missing[i] for i in batch], n_tokens) for batch, n_tokens in self.get_batches([texts[i] for i in missing])]
+
+        results = self.run(self.embed_batches([([texts[i] for i in batch], n_tokens) for batch, n_tokens in batches]))
+
+        for (batch, _), batch_vectors in zip(batches, results):
+            for i, vector in zip(batch, batch_vectors):
+                vectors[i] = vector
+
+        return vectors
 
     def get_embedding_vector(self, text: str):
-        embeddings_client = self.get_client()
-        response = embeddings_client.embed(
-            input=text,
-            model=self.model_deployment
-        )
+        return self.embed_many([text])[0]
 
-        embeddings_client.close() # add try-except
+    def get_chunk_objects(self, paragraphs: List[Dict]) -> List[Dict]:
+        vectors = self.embed_many([p[self.format_content_field] for p in paragraphs])
 
-        embedding = response.data[0].embedding
-        return embedding
+        return [{**paragraph, 'vector': vector} for paragraph, vector in zip(paragraphs, vectors)]
 
     def get_chunk_object(self, paragraph: Dict) -> Dict:
-        vector = self.get_embedding_vector(paragraph[self.format_content_field])
-
-        chunk = {
-                **paragraph,
-                'vector': vector
-            }
-        
-        return chunk
+        return self.get_chunk_objects([paragraph])[0]
+
+    def iter_chunk_objects(self, paragraphs: Iterable[Dict]) -> Iterator[Dict]:
+        paragraphs = iter(paragraphs)
+
+        while batch := list(islice(paragraphs, self.max_batch_inputs)):
+            yield from self.get_chunk_objects(batch)
@@ -1,9 +1,10 @@
 import os
-from dotenv import load_dotenv, find_dotenv
-load_dotenv(find_dotenv())
+from utils.env import load_env
+load_env()
 
 from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
+from azure.core.exceptions import HttpResponseError, ServiceRequestError
+from azure.search.documents import SearchClient, RequestEntityTooLargeError
 from azure.search.documents.indexes import SearchIndexClient
 from azure.search.documents.indexes.models import (
     SearchIndex,
@@ -13,6 +14,10 @@ from azure.search.documents.indexes.models import (
     SearchableField,
     VectorSearch,
     HnswAlgorithmConfiguration,
+    HnswParameters,
+    ScalarQuantizationCompression,
+    ScalarQuantizationParameters,
+    BinaryQuantizationCompression,
     VectorSearchProfile,
     SemanticConfiguration,
     SemanticPrioritizedFields,
@@ -20,7 +25,17 @@ from azure.search.documents.indexes.models import (
     SemanticField
 )
 
-import json
+import time
+import random
+import hashlib
+import orjson
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from utils.vector_codec import decode_chunk
+from utils.index_pointer import get_active_index, set_active_index, get_previous_indexes
+
+
+RETRY_STATUS = (409, 422, 429, 503) # transient, see IndexingResult.status_code
 
 
 class Index():
@@ -28,15 +43,32 @@ class Index():
         Build index and upload json chunks
     """
 
-    def __init__(self, title_field: str = "header", use_vector: bool = True):
+    def __init__(self, title_field: str = "header", use_vector: bool = True, index_name: str = None):
         self.search_endpoint = os.getenv("SEARCH_ENDPOINT")
         self.search_api_key = os.getenv("SEARCH_API_KEY")
 
-        self.index_name = os.getenv("INDEX_NAME")
+        # INDEX_NAME is the base name, the index serving it may be a version swapped in by a blue/green rebuild
+        self.base_index_name = os.getenv("INDEX_NAME")
+        self.index_name = index_name or get_active_index(self.base_index_name)
         self.vec_profile_name = os.getenv("VECTOR_SEARCH_PROFILE_NAME")
         self.vec_alg_conf_name = os.getenv("VECTOR_SEARCH_ALGORITHM_CONFIGURATION_NAME")
         self.sem_conf_name = os.getenv("SEMANTIC_CONFIGURATION_NAME")
 
+        # vector field and HNSW settings, trading recall against latency and memory
+        self.vector_dimensions = int(os.getenv("EMBEDDING_DIMENSIONS", 1536)) # text-embedding-3 models can be reduced, see Embedder
+        self.vector_stored = os.getenv("VECTOR_STORED", "true").lower() == "true"
+        self.vector_retrievable = os.getenv("VECTOR_RETRIEVABLE", "true").lower() == "true"
+        self.vector_compression = os.getenv("VECTOR_COMPRESSION", "none").lower() # none, scalar (int8) or binary
+        self.vec_compression_name = f"{self.vector_compression}-compression"
+        self.hnsw_parameters = {
+            "m": int(os.getenv("HNSW_M", 4)),
+            "ef_construction": int(os.getenv("HNSW_EF_CONSTRUCTION", 400)),
+            "ef_search": int(os.getenv("HNSW_EF_SEARCH", 500)),
+            "metric": os.getenv("HNSW_METRIC", "cosine"), # cosine, euclidean or dotProduct
+        }
+
+        assert self.vector_compression in ("none", "scalar", "binary")
+
         self.title_field = title_field
         self.use_vector = use_vector
 
@@ -78,7 +110,7 @@ class Index():
 
         client.close() # add try-except
 
-    def create_search_index(self):
+    def get_search_index(self) -> SearchIndex:
 
         # Define the index fields
         fields = [
@@ -93,35 +125,46 @@ class Index():
             SearchableField(name="header", type=SearchFieldDataType.String),
             SearchableField(name="raw_content", type=SearchFieldDataType.String, facetable=True),
             SearchableField(name="format_content", type=SearchFieldDataType.String),
-            SearchableField(name="page", type=SearchFieldDataType.Int32),
-            SearchableField(name="source", type=SearchFieldDataType.String),
+            SimpleField(name="page", type=SearchFieldDataType.Int32, filterable=True, sortable=True, facetable=True), # scoped queries, see retrieve(filter=...)
+            SearchableField(name="source", type=SearchFieldDataType.String, filterable=True, sortable=True, facetable=True),
             SearchableField(name="url", type=SearchFieldDataType.String),
         ]
 
         if self.use_vector: # otherwise use keyword-search only
 
-            # Add vector field
+            # Add vector field (not stored / not retrievable: searchable only, smaller index and responses)
             fields.append(
                 SearchField(name="vector", type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
                     searchable=True,
-                    vector_search_dimensions=1536, 
+                    hidden=not self.vector_retrievable or not self.vector_stored,
+                    stored=self.vector_stored,
+                    vector_search_dimensions=self.vector_dimensions,
                     vector_search_profile_name=self.vec_profile_name,
                     )
                 )
 
+            compressions = []
+            if self.vector_compression == "scalar":
+                compressions.append(ScalarQuantizationCompression(compression_name=self.vec_compression_name, parameters=ScalarQuantizationParameters(quantized_data_type="int8")))
+            elif self.vector_compression == "binary":
+                compressions.append(BinaryQuantizationCompression(compression_name=self.vec_compression_name))
+
             # Set the vector search configuration  
             vector_search = VectorSearch(
                 algorithms=[
                     HnswAlgorithmConfiguration(
-                        name=self.vec_alg_conf_name
+                        name=self.vec_alg_conf_name,
+                        parameters=HnswParameters(**self.hnsw_parameters)
                     )
                 ],
                 profiles=[
                     VectorSearchProfile(
                         name=self.vec_profile_name,
                         algorithm_configuration_name=self.vec_alg_conf_name,
+                        compression_name=self.vec_compression_name if compressions else None,
                     )
-                ]
+                ],
+                compressions=compressions or None
             )
 
         # Set the semantic configuration 
@@ -130,13 +173,19 @@ class Index():
             prioritized_fields=SemanticPrioritizedFields(
                 title_field=SemanticField(field_name="header"),
                 content_fields=[SemanticField(field_name="raw_content")],
-                keywords_fields=[SemanticField(field_name="page"), SemanticField(field_name="source")],
+                keywords_fields=[SemanticField(field_name="source")], # keyword fields must be searchable strings
             )
         )
 
         semantic_search = SemanticSearch(configurations=[semantic_config])
         
-        search_index = SearchIndex(name=self.index_name, fields=fields, vector_search=vector_search if self.use_vector else None, semantic_search=semantic_search)
+        return SearchIndex(name=self.index_name, fields=fields, vector_search=vector_search if self.use_vector else None, semantic_search=semantic_search)
+
+    def get_schema_hash(self) -> str:
+        return hashlib.sha256(orjson.dumps(self.get_search_index().as_dict(), option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+    def create_search_index(self):
+        search_index = self.get_search_index()
         
         client = self.get_search_index_client()
         result = client.create_or_update_index(search_index) # add try-except
@@ -144,17 +193,194 @@ class Index():
 
         client.close() # add try-except
 
-    def upload_to_index(self, data): # add overwrite
+    def get_version_name(self):
+        return f"{self.base_index_name}-v{time.strftime('%Y%m%d%H%M%S')}"
+
+    def get_document_count(self):
+        search_client = self.get_search_client()
+
+        try:
+            return search_client.get_document_count()
+        finally:
+            search_client.close()
+
+    def wait_for_count(self, expected: int, timeout: float = 900, interval: float = 10):
+        """
+            Poll the document count until it reaches expected, returns False on timeout
+        """
+        deadline = time.monotonic() + timeout
+
+        while True:
+            count = self.get_document_count()
+            print(f"   {count}/{expected} documents in '{self.index_name}'")
+
+            if count >= expected:
+                return True
+            if time.monotonic() + interval > deadline:
+                return False
+
+            time.sleep(interval)
+
+    def promote(self):
+        """
+            Repoint the base index name to this index, queries follow at their next call
+        """
+        set_active_index(self.base_index_name, self.index_name)
+        print(f"Index '{self.base_index_name}' now served by '{self.index_name}'")
+
+    def delete_old_versions(self, keep: int = 1):
+        """
+            Delete versions of the base index except the active one and the keep that served before it (for rollback).
+            Versions that were never promoted (e.g. incomplete builds) are deleted too.
+        """
+        client = self.get_search_index_client()
+
+        try:
+            keep_names = {get_active_index(self.base_index_name), *get_previous_indexes(self.base_index_name)[:keep]}
+            versions = sorted(name for name in client.list_index_names() if name.startswith(f"{self.base_index_name}-v") and name not in keep_names)
+
+            for name in versions:
+                client.delete_index(name)
+                print(f"Index '{name}' deleted.")
+        finally:
+            client.close()
+
+    def get_document_ids(self):
+        search_client = self.get_search_client()
+
+        try:
+            results = search_client.search(search_text="*", select=["id"])
+            document_ids = set(doc["id"] for doc in results)
+        finally:
+            search_client.close()
+
+        return document_ids
+
+    def delete_from_index(self, ids, batch_size: int = 1000):
+        """
+            Delete documents by key, returns the keys that could not be deleted
+        """
+        ids = list(ids)
+        failed_keys = []
+
         search_client = self.get_search_client()
 
+        try:
+            for i in range(0, len(ids), batch_size):
+                batch = ids[i:i+batch_size]
+                try:
+                    results = search_client.delete_documents(documents=[{"id": x} for x in batch])
+                    failed_keys.extend(result.key for result in results if not result.succeeded)
+                except Exception as e:
+                    print(f"Could not delete a batch of {len(batch)} documents ({e})")
+                    failed_keys.extend(batch)
+        finally:
+            search_client.close()
+
+        return failed_keys
+
+    def get_batches(self, data, batch_size: int = 1000, max_batch_bytes: int = 8_000_000):
+        """
+            Group chunks into batches bounded by number of documents and (JSON) payload bytes
+        """
+        batch, batch_bytes = [], 0
+
         for chunk in data:
-            local_file_name = chunk[self.title_field]
+            n_bytes = len(orjson.dumps(chunk))
+
+            if batch and (len(batch) >= batch_size or batch_bytes + n_bytes > max_batch_bytes):
+                yield batch
+                batch, batch_bytes = [], 0
+
+            batch.append(chunk)
+            batch_bytes += n_bytes
+
+        if batch:
+            yield batch
+
+    def upload_batch(self, search_client: SearchClient, batch, max_retries: int = 3):
+        """
+            Merge-or-upload a batch, retrying only the documents that failed with a transient status.
+            Returns the keys of the documents that still failed.
+        """
+        failed_keys = []
+
+        for attempt in range(max_retries + 1):
+            if attempt:
+                time.sleep(random.uniform(0, 2 ** attempt)) # jittered backoff
 
             try:
-                result = search_client.upload_documents(documents=json.dumps(chunk))
-                print(f"\nUpload of {local_file_name} succeeded: { result[0].succeeded }")
-                # print("Upload of '{}'.. succeeded? {}".format(local_file_name, result[0].succeeded))
-            except Exception as e:
-                print(f"Could not upload + {local_file_name} ({e})")
-            
-        search_client.close() # add try-except
+                results = search_client.merge_or_upload_documents(documents=batch)
+            except RequestEntityTooLargeError as e:
+                if len(batch) == 1:
+                    print(f"Could not upload '{batch[0]['id']}', too large ({e})")
+                    return failed_keys + [batch[0]["id"]]
+                half = len(batch) // 2
+                return failed_keys + self.upload_batch(search_client, batch[:half], max_retries) + self.upload_batch(search_client, batch[half:], max_retries)
+            except (HttpResponseError, ServiceRequestError) as e:
+                status_code = getattr(e, "status_code", None)
+                if (status_code is None or status_code in RETRY_STATUS) and attempt < max_retries: # connection errors are transient too
+                    continue
+                print(f"Could not upload a batch of {len(batch)} documents ({e})")
+                return failed_keys + [chunk["id"] for chunk in batch]
+            except Exception as e: # never abort the other batches, the keys are reported as failed
+                print(f"Could not upload a batch of {len(batch)} documents ({e})")
+                return failed_keys + [chunk["id"] for chunk in batch]
+
+            retry_keys = set()
+
+            for result in results:
+                if result.succeeded:
+                    continue
+                if result.status_code in RETRY_STATUS:
+                    retry_keys.add(result.key)
+                else:
+                    print(f"Could not upload '{result.key}' ({result.status_code}: {result.error_message})")
+                    failed_keys.append(result.key)
+
+            batch = [chunk for chunk in batch if chunk["id"] in retry_keys]
+
+            if not batch:
+                break
+
+        return failed_keys + [chunk["id"] for chunk in batch]
+
+    def upload_to_index(self, data, skip_existing: bool = False, batch_size: int = 1000, max_batch_bytes: int = 8_000_000, max_workers: int = 4):
+        """
+            Merge-or-upload the chunks in parallel batches (up to 1000 documents), with skip_existing the ids already in the index are not sent again.
+            Returns a summary of succeeded and failed documents.
+        """
+        existing_ids = self.get_document_ids() if skip_existing else set()
+
+        # the index only takes float lists
+        data = (decode_chunk(chunk) for chunk in data if chunk["id"] not in existing_ids)
+
+        search_client = self.get_search_client()
+
+        start = time.perf_counter()
+        total, failed_keys = 0, []
+
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = []
+                for batch in self.get_batches(data, batch_size=batch_size, max_batch_bytes=max_batch_bytes):
+                    total += len(batch)
+                    futures.append(executor.submit(self.upload_batch, search_client, batch))
+
+                for future in as_completed(futures):
+                    failed_keys.extend(future.result())
+        finally:
+            search_client.close()
+
+        elapsed = time.perf_counter() - start
+
+        summary = {"succeeded": total - len(failed_keys),
+                   "failed": len(failed_keys),
+                   "failed_keys": failed_keys,
+                   "batches": len(futures),
+                   "elapsed": round(elapsed, 2),
+                   "docs_per_second": round(total / elapsed, 1) if elapsed else 0.0}
+
+        print(f"Uploaded {summary['succeeded']}/{total} documents in {summary['batches']} batches ({summary['elapsed']}s, {summary['docs_per_second']} docs/s)")
+
+        return summary
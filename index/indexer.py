@@ -1,6 +1,6 @@
 import os
-from dotenv import load_dotenv, find_dotenv
-load_dotenv(find_dotenv())
+from utils.env import load_env
+load_env()
 
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents.indexes import SearchIndexerClient
@@ -9,21 +9,30 @@ from azure.search.documents.indexes.models import (
     FieldMapping
 )
 
+from utils.index_pointer import get_active_index
+
+import time
+from datetime import datetime, timedelta, timezone
+
 
 class Indexer():
     """
         Connect index to data source and skillset
     """
 
-    def __init__(self):
+    def __init__(self, index_name: str = None, parsing_mode: str = "json"):
         self.search_endpoint = os.getenv("SEARCH_ENDPOINT")
         self.search_api_key = os.getenv("SEARCH_API_KEY")
 
         self.indexer_name=os.getenv("INDEXER_NAME")
-        self.index_name = os.getenv("INDEX_NAME")
+        self.index_name = index_name or get_active_index(os.getenv("INDEX_NAME"))
         self.data_source_name = os.getenv("DATA_SOURCE_NAME")
         # self.skillset_name = os.getenv("SKILLSET_NAME")
 
+        self.parsing_mode = parsing_mode # 'jsonLines' for packed blobs, see Storage.pack_size
+
+        self.started_at = None # start of the run launched by build_indexer
+
     def get_indexer_client(self):
         indexer_client = SearchIndexerClient(
             endpoint=self.search_endpoint, credential=AzureKeyCredential(self.search_api_key)
@@ -31,7 +40,7 @@ class Indexer():
         return indexer_client
     
     def build_indexer(self):
-        indexer_parameters = {"configuration": {"parsingMode": "json"}}
+        indexer_parameters = {"configuration": {"parsingMode": self.parsing_mode}}
 
         indexer = SearchIndexer(  
             name=self.indexer_name,  
@@ -53,6 +62,72 @@ class Indexer():
         # Create the indexer  
         result = indexer_client.create_or_update_indexer(indexer) # add try-except
 
-        print(f'{result.name} is created and running. Give the indexer a few minutes before running a query.')
+        self.started_at = datetime.now(timezone.utc)
+
+        print(f'{result.name} is created and running. Give the indexer a few minutes before running a query (or wait_for_completion).')
 
         indexer_client.close() # add try-except
+
+
+    def delete_indexer(self):
+        indexer_client = self.get_indexer_client()
+
+        try:
+            indexer_client.delete_indexer(self.indexer_name)
+            print(f"Indexer '{self.indexer_name}' deleted.")
+        except Exception as e:
+            print(f"Could not delete the indexer '{self.indexer_name}' ({e}).")
+        finally:
+            indexer_client.close()
+
+    def wait_for_completion(self, expected_items: int = None, timeout: float = 1800, interval: float = 5):
+        """
+            Poll the indexer status until its run ends or timeout, printing progress (docs/s, ETA if expected_items is given).
+            Returns the run status, processed and failed items, errors, elapsed seconds and throughput.
+        """
+        indexer_client = self.get_indexer_client()
+
+        start = time.monotonic()
+        started_at = self.started_at
+
+        run = {"status": "timeout", "items_processed": 0, "items_failed": 0, "errors": [], "elapsed": 0.0, "docs_per_second": 0.0}
+
+        try:
+            while True:
+                status = indexer_client.get_indexer_status(self.indexer_name)
+                last = status.last_result
+
+                elapsed = time.monotonic() - start
+
+                # before the new run shows up, last_result is the one of the previous indexer
+                if last and (started_at is None or last.start_time is None or last.start_time >= started_at - timedelta(minutes=1)):
+                    processed = last.item_count or 0
+                    run.update(status=last.status,
+                               items_processed=processed,
+                               items_failed=last.failed_item_count or 0,
+                               errors=[error.error_message for error in last.errors or []],
+                               elapsed=round(elapsed, 1),
+                               docs_per_second=round(processed / elapsed, 1) if elapsed else 0.0)
+
+                    eta = f", ETA {(expected_items - processed) / run['docs_per_second']:.0f}s" if expected_items and run["docs_per_second"] and processed < expected_items else ""
+                    print(f"   {last.status}: {processed}{f'/{expected_items}' if expected_items else ''} items, {run['items_failed']} failed, {run['docs_per_second']} docs/s{eta}")
+
+                    if last.status != "inProgress":
+                        break
+
+                if status.status == "error":
+                    run["status"] = "error"
+                    break
+
+                if elapsed + interval > timeout:
+                    run["status"] = "timeout"
+                    break
+
+                time.sleep(interval)
+        finally:
+            indexer_client.close()
+
+        run["elapsed"] = round(time.monotonic() - start, 1)
+        print(f"Indexer '{self.indexer_name}' finished with status '{run['status']}' in {run['elapsed']}s")
+
+        return run
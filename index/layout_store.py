@@ -0,0 +1,175 @@
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from azure.ai.documentintelligence.models import AnalyzeResult, ParagraphRole
+
+
+DOCUMENTS_SCHEMA = pa.schema([
+    ("doc_idx", pa.int32()),
+    ("file_name", pa.string()),
+    ("split_offset", pa.int32()),
+    ("url", pa.string()),
+])
+
+PARAGRAPHS_SCHEMA = pa.schema([
+    ("doc_idx", pa.int32()),
+    ("paragraph_idx", pa.int32()),
+    ("role", pa.string()),
+    ("content", pa.string()),
+    ("page_numbers", pa.list_(pa.int32())),
+])
+
+TABLES_SCHEMA = pa.schema([
+    ("doc_idx", pa.int32()),
+    ("table_idx", pa.int32()),
+    ("row_count", pa.int32()),
+    ("column_count", pa.int32()),
+    ("footnote", pa.string()),
+])
+
+CELLS_SCHEMA = pa.schema([
+    ("doc_idx", pa.int32()),
+    ("table_idx", pa.int32()),
+    ("row_index", pa.int32()),
+    ("column_index", pa.int32()),
+    ("content", pa.string()),
+])
+
+SPANS_SCHEMA = pa.schema([
+    ("doc_idx", pa.int32()),
+    ("owner", pa.string()), # 'paragraph' or 'table'
+    ("owner_idx", pa.int32()),
+    ("offset", pa.int64()),
+    ("length", pa.int64()),
+])
+
+IMAGES_SCHEMA = pa.schema([
+    ("image", pa.string()),
+    ("title", pa.string()),
+    ("description", pa.string()),
+])
+
+
+class LayoutStore():
+    """
+        Columnar (Parquet) storage of the layout fields used for formatting, instead of pickled SDK objects
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def table_path(self, name):
+        return os.path.join(self.path, f"{name}.parquet")
+
+    def export(self, results):
+        os.makedirs(self.path, exist_ok=True)
+
+        rows = {name: [] for name in ["documents", "paragraphs", "tables", "cells", "spans"]}
+
+        for doc_idx, doc_res in enumerate(results["documents"]):
+            result = doc_res["result"]
+
+            rows["documents"].append({"doc_idx": doc_idx,
+                                      "file_name": doc_res["file_name"],
+                                      "split_offset": int(doc_res["split_offset"]),
+                                      "url": doc_res["url"]})
+
+            for paragraph_idx, paragraph in enumerate(result.paragraphs or []):
+                rows["paragraphs"].append({"doc_idx": doc_idx,
+                                           "paragraph_idx": paragraph_idx,
+                                           "role": ParagraphRole(paragraph.role).value if paragraph.role else None,
+                                           "content": paragraph.content,
+                                           "page_numbers": [int(region.page_number) for region in paragraph.bounding_regions or []]})
+
+                for span in paragraph.spans:
+                    rows["spans"].append({"doc_idx": doc_idx, "owner": "paragraph", "owner_idx": paragraph_idx, "offset": span["offset"], "length": span["length"]})
+
+            for table_idx, table in enumerate(result.tables or []):
+                rows["tables"].append({"doc_idx": doc_idx,
+                                       "table_idx": table_idx,
+                                       "row_count": table.row_count,
+                                       "column_count": table.column_count,
+                                       "footnote": table.footnotes[-1].content if table.footnotes else None})
+
+                for cell in table.cells:
+                    rows["cells"].append({"doc_idx": doc_idx, "table_idx": table_idx, "row_index": cell.row_index, "column_index": cell.column_index, "content": cell.content})
+
+                for span in table.spans:
+                    rows["spans"].append({"doc_idx": doc_idx, "owner": "table", "owner_idx": table_idx, "offset": span["offset"], "length": span["length"]})
+
+        schemas = {"documents": DOCUMENTS_SCHEMA, "paragraphs": PARAGRAPHS_SCHEMA, "tables": TABLES_SCHEMA, "cells": CELLS_SCHEMA, "spans": SPANS_SCHEMA}
+
+        for name, schema in schemas.items():
+            pq.write_table(pa.Table.from_pylist(rows[name], schema=schema), self.table_path(name), compression="zstd")
+
+        images = [{"image": res["image"], "title": res["result"].title, "description": res["result"].description} for res in results["images"] or []]
+        pq.write_table(pa.Table.from_pylist(images, schema=IMAGES_SCHEMA), self.table_path("images"), compression="zstd")
+
+    def read(self, name, columns=None):
+        return pq.read_table(self.table_path(name), columns=columns, memory_map=True).to_pylist()
+
+    def load(self):
+        documents = self.read("documents")
+
+        layouts = [{"paragraphs": [], "tables": []} for _ in documents]
+
+        for par in self.read("paragraphs", columns=["doc_idx", "role", "content", "page_numbers"]):
+            layouts[par["doc_idx"]]["paragraphs"].append({
+                "content": par["content"],
+                "role": par["role"],
+                "spans": [],
+                "boundingRegions": [{"pageNumber": page, "polygon": []} for page in par["page_numbers"]]
+                })
+
+        for tab in self.read("tables", columns=["doc_idx", "row_count", "column_count", "footnote"]):
+            layouts[tab["doc_idx"]]["tables"].append({
+                "rowCount": tab["row_count"],
+                "columnCount": tab["column_count"],
+                "cells": [],
+                "spans": [],
+                "footnotes": [{"content": tab["footnote"]}] if tab["footnote"] is not None else None
+                })
+
+        for cell in self.read("cells"):
+            layouts[cell["doc_idx"]]["tables"][cell["table_idx"]]["cells"].append({
+                "rowIndex": cell["row_index"],
+                "columnIndex": cell["column_index"],
+                "content": cell["content"]
+                })
+
+        for span in self.read("spans"):
+            owner = "paragraphs" if span["owner"] == "paragraph" else "tables"
+            layouts[span["doc_idx"]][owner][span["owner_idx"]]["spans"].append({"offset": span["offset"], "length": span["length"]})
+
+        documents_results = [{
+            "file_name": doc["file_name"],
+            "split_offset": doc["split_offset"],
+            "url": doc["url"],
+            "result": AnalyzeResult(layout)
+            } for doc, layout in zip(documents, layouts)]
+
+        from agents.image_agents import ResultOutput
+
+        images = self.read("images")
+        images_results = [{"image": img["image"], "result": ResultOutput(title=img["title"], description=img["description"])} for img in images] or None
+
+        return {"documents": documents_results, "images": images_results}
+
+
+
+if __name__ == "__main__":
+    import argparse
+    import pickle
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("pkl_file", type=str, help="pickled layout results, e.g. 'data/results.pkl'")
+    parser.add_argument("layout_dir", type=str, help="output directory of the parquet tables")
+    args = parser.parse_args()
+
+    with open(args.pkl_file, "rb") as fin:
+        results = pickle.load(fin)
+
+    LayoutStore(args.layout_dir).export(results)
+    print(f"Layout of '{args.pkl_file}' exported to '{args.layout_dir}'")
@@ -0,0 +1,60 @@
+import os
+import json
+import hashlib
+
+from typing import List, Dict, Tuple
+
+import orjson
+
+
+class IndexManifest():
+    """
+        Chunk id -> content hash of the last indexing run (plus the schema hash), to reindex by diff.
+        Also keeps chunk id -> blob name, and the blobs whose deletion failed, to apply the diff to the container.
+    """
+
+    def __init__(self, index_name: str, manifest_dir: str = "data/manifests"):
+        os.makedirs(manifest_dir, exist_ok=True)
+
+        self.index_name = index_name
+        self.path = os.path.join(manifest_dir, f"{index_name}.json")
+
+    def chunk_hash(self, chunk: Dict, ignore_fields=("vector",)) -> str:
+        # vectors follow from the content, they are not hashed
+        content = {k: v for k, v in chunk.items() if k not in ignore_fields}
+        return hashlib.sha256(orjson.dumps(content, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.path)
+
+    def load(self) -> Dict:
+        if not self.exists():
+            return {"schema": None, "chunks": {}, "blobs": {}, "stale_blobs": []}
+
+        with open(self.path, "r") as fin:
+            return {"blobs": {}, "stale_blobs": [], **json.load(fin)}
+
+    def save(self, schema: str, chunks: Dict[str, str], blobs: Dict[str, str] = None, stale_blobs: List[str] = None):
+        tmp_path = self.path + ".tmp"
+
+        with open(tmp_path, "w") as fout:
+            json.dump({"index": self.index_name, "schema": schema, "chunks": chunks, "blobs": blobs or {}, "stale_blobs": stale_blobs or []}, fout)
+
+        os.replace(tmp_path, self.path)
+
+    def delete(self):
+        if self.exists():
+            os.remove(self.path)
+
+    def diff(self, old_chunks: Dict[str, str], chunks: List[Dict]) -> Tuple[List[Dict], List[Dict], List[str], Dict[str, str]]:
+        """
+            Returns added chunks, changed chunks, removed ids and the new id -> hash map.
+            An old hash of None (id known, content not) counts as unchanged: ids are content hashes too.
+        """
+        new_chunks = {chunk["id"]: self.chunk_hash(chunk) for chunk in chunks}
+
+        added = [chunk for chunk in chunks if chunk["id"] not in old_chunks]
+        changed = [chunk for chunk in chunks if chunk["id"] in old_chunks and old_chunks[chunk["id"]] not in (None, new_chunks[chunk["id"]])]
+        removed = [chunk_id for chunk_id in old_chunks if chunk_id not in new_chunks]
+
+        return added, changed, removed, new_chunks
@@ -0,0 +1,75 @@
+import re
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+
+from typing import List
+
+
+DIGITS_RE = re.compile(r'\d+')
+PUNCTUATION_RE = re.compile(r'[^\w\s]')
+
+NLTK_RESOURCES = {"wordnet": "corpora/wordnet", "stopwords": "corpora/stopwords"}
+
+
+def ensure_nltk_data():
+    import nltk
+
+    # download only what is missing, on first use instead of at import
+    for package, resource in NLTK_RESOURCES.items():
+        try:
+            nltk.data.find(resource)
+        except LookupError:
+            nltk.download(package, quiet=True)
+
+
+class TextNormalizer():
+    """
+        Lowercase, drop digits, punctuation and stopwords, lemmatize (memoized)
+    """
+
+    def __init__(self, language: str = "english", cache_size: int = 100_000):
+        self.language = language
+        self.cache_size = cache_size
+
+        ensure_nltk_data()
+
+        from nltk.corpus import stopwords
+        from nltk.stem import WordNetLemmatizer
+
+        self.stopwords = frozenset(stopwords.words(language))
+        self.lemmatizer = WordNetLemmatizer()
+        self.lemmatize = lru_cache(maxsize=cache_size)(self.lemmatizer.lemmatize)
+
+    def normalize(self, text: str) -> str:
+        format_text = text.strip().lower()
+        format_text = DIGITS_RE.sub('', format_text)
+        format_text = PUNCTUATION_RE.sub('', format_text)
+
+        words = [self.lemmatize(word) for word in format_text.split() if word not in self.stopwords]
+        format_text = ' '.join(words)
+
+        return format_text
+
+    def normalize_many(self, texts: List[str], workers: int = None, chunksize: int = 64) -> List[str]:
+        """
+            Normalize a batch of texts, fanning out across a process pool when workers > 1
+        """
+        texts = list(texts)
+
+        if not workers or workers <= 1 or len(texts) <= chunksize:
+            return [self.normalize(text) for text in texts]
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(self.language, self.cache_size)) as executor:
+            return list(executor.map(normalize_in_worker, texts, chunksize=chunksize))
+
+
+### process pool workers build their own normalizer once
+
+worker_normalizer = None
+
+def init_worker(language, cache_size):
+    global worker_normalizer
+    worker_normalizer = TextNormalizer(language=language, cache_size=cache_size)
+
+def normalize_in_worker(text):
+    return worker_normalizer.normalize(text)
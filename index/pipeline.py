@@ -0,0 +1,87 @@
+import queue
+import threading
+
+from typing import Callable, Iterable
+
+
+END = object()
+
+
+class StageError():
+    def __init__(self, exception: Exception):
+        self.exception = exception
+
+
+class Pipeline():
+    """
+        Stream items through generator stages, each in its own thread, connected by bounded queues
+    """
+
+    def __init__(self, max_queue_size: int = 64):
+        self.max_queue_size = max_queue_size
+        self.stages = []
+
+    def add_stage(self, func: Callable[[Iterable], Iterable]):
+        """
+            func maps an iterable of items to an iterable (typically a generator) of items
+        """
+        self.stages.append(func)
+        return self
+
+    def put(self, q, item, stop_event):
+        while not stop_event.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def drain(self, q, stop_event):
+        while not stop_event.is_set():
+            try:
+                item = q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            if item is END:
+                return
+            if isinstance(item, StageError):
+                raise item.exception
+
+            yield item
+
+    def feed(self, func, items, q, stop_event):
+        try:
+            for item in func(items):
+                if not self.put(q, item, stop_event):
+                    return
+            self.put(q, END, stop_event)
+        except Exception as e:
+            self.put(q, StageError(e), stop_event)
+
+    def run(self, source: Iterable, sink: Callable[[Iterable], object]):
+        """
+            Run the stages over source and consume the output with sink in the calling thread
+        """
+        stop_event = threading.Event()
+        threads = []
+
+        items = source
+
+        for func in self.stages:
+            q = queue.Queue(maxsize=self.max_queue_size)
+
+            thread = threading.Thread(target=self.feed, args=(func, items, q, stop_event), daemon=True)
+            thread.start()
+            threads.append(thread)
+
+            items = self.drain(q, stop_event)
+
+        try:
+            return sink(items)
+        finally:
+            stop_event.set()
+
+            for thread in threads:
+                thread.join()
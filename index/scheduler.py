@@ -0,0 +1,168 @@
+import time
+import random
+import asyncio
+
+from typing import List, Tuple, Callable, Awaitable, Optional
+
+from azure.core.exceptions import HttpResponseError, ServiceRequestError
+
+
+RETRY_STATUS = (408, 429, 500, 502, 503, 504)
+
+
+class TokenBucket():
+    """
+        Budget of units per minute (requests or tokens), refilled continuously
+    """
+
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: int) -> float:
+        self.refill()
+        amount = min(amount, self.capacity) # a request larger than the whole budget waits for a full bucket
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+    def take(self, amount: int):
+        self.tokens -= min(amount, self.capacity)
+
+
+class EmbeddingScheduler():
+    """
+        Run embedding requests concurrently within requests-per-minute and tokens-per-minute budgets.
+        Throttled (429) and transient errors are retried after Retry-After, or a jittered exponential backoff.
+    """
+
+    def __init__(self, rpm: int = None, tpm: int = None, max_in_flight: int = 8, max_retries: int = 8, backoff_base: float = 1.0, backoff_max: float = 60.0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        # budgets and throttling pause are shared by all runs of the scheduler
+        self.rpm_bucket = TokenBucket(rpm) if rpm else None
+        self.tpm_bucket = TokenBucket(tpm) if tpm else None
+        self.paused_until = 0.0
+
+        # asyncio primitives are bound to the event loop of the first run, see get_primitives
+        self.loop = None
+        self.lock = None
+        self.semaphore = None
+
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.tokens = 0
+        self.elapsed = 0.0
+
+    def get_retry_after(self, error: HttpResponseError) -> Optional[float]:
+        headers = error.response.headers if error.response is not None else {}
+
+        try:
+            if "retry-after-ms" in headers:
+                return float(headers["retry-after-ms"]) / 1000
+            if "Retry-After" in headers:
+                return float(headers["Retry-After"])
+        except ValueError: # HTTP-date form, fall back to backoff
+            pass
+
+        return None
+
+    def get_backoff(self, attempt: int) -> float:
+        # full jitter, so that concurrent requests do not retry in lockstep
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    async def acquire(self, n_tokens: int):
+        async with self.lock:
+            while True:
+                pause = self.paused_until - time.monotonic()
+                if self.rpm:
+                    pause = max(pause, self.rpm_bucket.wait_time(1))
+                if self.tpm:
+                    pause = max(pause, self.tpm_bucket.wait_time(n_tokens))
+
+                if pause <= 0:
+                    break
+
+                await asyncio.sleep(pause)
+
+            if self.rpm:
+                self.rpm_bucket.take(1)
+            if self.tpm:
+                self.tpm_bucket.take(n_tokens)
+
+    async def submit(self, func: Callable[[], Awaitable], n_tokens: int):
+        async with self.semaphore:
+            for attempt in range(self.max_retries + 1):
+                await self.acquire(n_tokens)
+
+                try:
+                    result = await func()
+
+                except HttpResponseError as e:
+                    if e.status_code not in RETRY_STATUS or attempt == self.max_retries:
+                        raise
+
+                    retry_after = self.get_retry_after(e)
+                    delay = retry_after if retry_after is not None else self.get_backoff(attempt)
+
+                    if e.status_code == 429: # the quota is shared, hold back every request
+                        self.throttled += 1
+                        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+                except ServiceRequestError:
+                    if attempt == self.max_retries:
+                        raise
+                    delay = self.get_backoff(attempt)
+
+                else:
+                    self.requests += 1
+                    self.tokens += n_tokens
+                    return result
+
+                self.retries += 1
+                await asyncio.sleep(delay)
+
+    def get_primitives(self):
+        loop = asyncio.get_running_loop()
+
+        if loop is not self.loop: # new event loop (e.g. asyncio.run per call): buckets and pause are kept
+            self.loop = loop
+            self.lock = asyncio.Lock()
+            self.semaphore = asyncio.Semaphore(self.max_in_flight)
+
+    async def run(self, requests: List[Tuple[Callable[[], Awaitable], int]]) -> List:
+        """
+            Run (coroutine function, number of tokens) requests, results are returned in order
+        """
+        self.get_primitives()
+
+        start = time.perf_counter()
+        try:
+            return await asyncio.gather(*[self.submit(func, n_tokens) for func, n_tokens in requests])
+        finally:
+            self.elapsed += time.perf_counter() - start
+
+    def stats(self):
+        # runs shorter than a minute did all their tokens within one minute
+        minutes = max(self.elapsed / 60, 1.0) if self.elapsed else 0
+
+        return {"requests": self.requests,
+                "retries": self.retries,
+                "throttled": self.throttled,
+                "tokens": self.tokens,
+                "elapsed": round(self.elapsed, 2),
+                "tpm": round(self.tokens / minutes) if minutes else 0}
@@ -0,0 +1,42 @@
+from bisect import bisect_right
+from typing import List, Dict, Optional
+
+
+class SpanIndex():
+    """
+        Sorted interval index over spans, finds the span containing an offset in O(log n)
+    """
+
+    def __init__(self, spans: List[Dict]):
+        # sort by offset, ties keep the original order
+        order = sorted(range(len(spans)), key=lambda i: spans[i]["offset"])
+
+        self.positions = order
+        self.starts = [spans[i]["offset"] for i in order]
+        self.ends = [spans[i]["offset"] + spans[i]["length"] for i in order]
+
+        # running max of the ends, so a backward scan can stop early on overlapping spans
+        self.max_ends = []
+        max_end = None
+        for end in self.ends:
+            max_end = end if max_end is None else max(max_end, end)
+            self.max_ends.append(max_end)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def find(self, offset: int) -> Optional[int]:
+        """
+            Returns the position (in the original list) of the last span such that
+            span.offset <= offset <= span.offset + span.length, or None
+        """
+        found = None
+
+        i = bisect_right(self.starts, offset) - 1
+
+        while i >= 0 and self.max_ends[i] >= offset:
+            if self.ends[i] >= offset and (found is None or self.positions[i] > found):
+                found = self.positions[i]
+            i -= 1
+
+        return found
@@ -1,16 +1,24 @@
 import os
-from dotenv import load_dotenv, find_dotenv
-load_dotenv(find_dotenv())
+from utils.env import load_env
+load_env()
 
 from azure.core.credentials import AzureKeyCredential
 from azure.storage.blob import BlobServiceClient
+from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
 from azure.search.documents.indexes import SearchIndexerClient
 from azure.search.documents.indexes.models import (
     SearchIndexerDataContainer,
     SearchIndexerDataSourceConnection
 )
 
-import json
+import time
+import asyncio
+import orjson
+
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceNotModifiedError
+
+from utils.vector_codec import dumps, loads, ENCODINGS
 
 
 class Storage():
@@ -18,7 +26,7 @@ class Storage():
         Add index data source connection to Blob Storage and upload json chunks
     """
 
-    def __init__(self, title_field: str = "header"):
+    def __init__(self, title_field: str = "header", vector_encoding: str = None, pack_size: int = None, pack_bytes: int = 8_000_000):
         self.search_endpoint = os.getenv("SEARCH_ENDPOINT")
         self.search_api_key = os.getenv("SEARCH_API_KEY")
 
@@ -32,6 +40,19 @@ class Storage():
         self.container_name = os.getenv("CONTAINER_NAME")
 
         self.title_field = title_field
+
+        # None keeps 'vector' as a float list (the blob indexer maps it to the index),
+        # otherwise it's stored as base64 in 'vector_encoded' for compact archives read back by list_container
+        assert vector_encoding is None or vector_encoding in ENCODINGS
+        self.vector_encoding = vector_encoding
+
+        # pack chunks into json-lines blobs (indexer parsingMode 'jsonLines') instead of one blob per chunk
+        self.pack_size = pack_size
+        self.pack_bytes = pack_bytes
+
+        # local copy of the container, see list_container
+        self.snapshot_dir = os.getenv("CONTAINER_SNAPSHOT_DIR", "data/container_snapshot")
+        self.snapshot = None
     
     def get_indexer_client(self):
         indexer_client = SearchIndexerClient(
@@ -65,74 +86,249 @@ class Storage():
 
         indexer_client.close() # add try-except
 
-    def list_container(self):
-        storage_client = self.get_storage_client()
-        container_client = storage_client.get_container_client(self.container_name)
+    def get_snapshot_path(self):
+        return os.path.join(self.snapshot_dir, f"{self.container_name}.json")
 
-        blob_list = container_client.list_blobs()
+    def load_snapshot(self):
+        if self.snapshot is None:
+            try:
+                with open(self.get_snapshot_path(), "rb") as fin:
+                    self.snapshot = orjson.loads(fin.read())
+            except FileNotFoundError:
+                self.snapshot = {}
+        return self.snapshot
 
-        contents = []
+    def save_snapshot(self, snapshot):
+        os.makedirs(self.snapshot_dir, exist_ok=True)
 
-        for blob in blob_list: # add try-except
-            blob_name = blob.name
-            blob_client = self.get_blob_client(storage_client=storage_client, file_name=blob_name)
-            content = blob_client.download_blob(encoding="utf-8").content_as_text()
-            
-            try:
-                content = content.replace("null", "None")
-                content_as_dict = eval(content)
-            except Exception as e:
-                print(e)
+        tmp_path = self.get_snapshot_path() + ".tmp"
+        with open(tmp_path, "wb") as fout:
+            fout.write(orjson.dumps(snapshot))
+        os.replace(tmp_path, self.get_snapshot_path())
+
+        self.snapshot = snapshot
+
+    def parse_blob(self, name, content):
+        # json-lines packs hold many chunks, json blobs one
+        if name.endswith(".jsonl"):
+            return [loads(line) for line in content.splitlines() if line.strip()]
+        return [loads(content)]
+
+    async def list_async(self, max_concurrency=16):
+        """
+            Returns {blob name: {"etag", "chunks"}}, downloading only the blobs whose ETag is not in the snapshot
+        """
+        snapshot = self.load_snapshot()
+        storage_client = AsyncBlobServiceClient(account_url=self.storage_account_url, credential=self.storage_api_key)
+
+        async with storage_client:
+            container_client = storage_client.get_container_client(self.container_name)
+
+            etags = {blob.name: blob.etag async for blob in container_client.list_blobs()}
+
+            semaphore = asyncio.Semaphore(max_concurrency)
+
+            async def download(name):
+                cached = snapshot.get(name)
+
+                async with semaphore:
+                    try:
+                        if cached: # conditional request, in case the blob changed back since the listing
+                            downloader = await container_client.download_blob(name, etag=cached["etag"], match_condition=MatchConditions.IfModified)
+                        else:
+                            downloader = await container_client.download_blob(name)
+                        content = await downloader.readall()
+                    except ResourceNotModifiedError:
+                        return name, cached
+                    except Exception as e:
+                        print(f"Could not read {name} ({e})")
+                        return name, None
+
+                try:
+                    return name, {"etag": downloader.properties.etag, "chunks": self.parse_blob(name, content)}
+                except Exception as e:
+                    print(f"Could not parse {name} ({e})")
+                    return name, {"etag": downloader.properties.etag, "chunks": []} # not downloaded again until it changes
+
+            changed = [name for name, etag in etags.items() if name not in snapshot or snapshot[name]["etag"] != etag]
+            downloaded = dict(await asyncio.gather(*[download(name) for name in changed]))
+
+        new_snapshot = {}
+        for name, etag in etags.items():
+            entry = downloaded[name] if name in downloaded else snapshot[name]
+            if entry is not None:
+                new_snapshot[name] = entry
+
+        return new_snapshot, len(changed)
+
+    def list_container(self, max_concurrency=16):
+        """
+            Returns the contents of all blobs. Blobs are downloaded concurrently and cached in a local snapshot keyed by name and ETag,
+            so an unchanged container costs a single list call.
+        """
+        snapshot, n_changed = asyncio.run(self.list_async(max_concurrency=max_concurrency))
+
+        if n_changed or snapshot.keys() != self.load_snapshot().keys():
+            self.save_snapshot(snapshot)
+
+        return [chunk for entry in snapshot.values() for chunk in entry["chunks"]]
+
+    async def erase_async(self, prefix=None, names=None, batch_size=256, max_concurrency=8):
+        storage_client = AsyncBlobServiceClient(account_url=self.storage_account_url, credential=self.storage_api_key)
+
+        deleted, failed = 0, []
+
+        async with storage_client:
+            container_client = storage_client.get_container_client(self.container_name)
 
-            contents.append(content_as_dict)
+            if names is None:
+                names = [name async for name in container_client.list_blob_names(name_starts_with=prefix)]
 
-        container_client.close()
-        storage_client.close() 
+            semaphore = asyncio.Semaphore(max_concurrency)
 
-        return contents
+            async def delete(batch):
+                nonlocal deleted, failed
+                async with semaphore:
+                    try:
+                        responses = await container_client.delete_blobs(*batch, raise_on_any_failure=False)
+                        names_iter = iter(batch) # one response per blob, in order
+                        async for response in responses:
+                            name = next(names_iter)
+                            if response.status_code in (202, 404): # already gone counts as deleted
+                                deleted += 1
+                            else:
+                                failed.append(name)
+                    except Exception as e:
+                        failed.extend(batch)
+                        print(f"Could not delete a batch of {len(batch)} blobs ({e})")
 
-    def erase_container(self):
-        storage_client = self.get_storage_client()
-        container_client = storage_client.get_container_client(self.container_name)
+            # a blob batch request takes at most 256 sub-requests
+            await asyncio.gather(*[delete(names[i:i+batch_size]) for i in range(0, len(names), batch_size)])
 
-        blob_list = container_client.list_blobs()
+        return deleted, failed
 
-        for blob in blob_list: # add try-except
-            blob_name = blob.name
-            blob_client = self.get_blob_client(storage_client=storage_client, file_name=blob_name)
-            blob_client.delete_blob()
-            blob_client.close()
-        
-        print(f"All blobs in container '{self.container_name}' deleted.")
+    def erase_container(self, prefix=None, names=None, batch_size=256, max_concurrency=8):
+        """
+            Delete all blobs (or those starting with prefix, or the given names) in concurrent batch requests.
+            Returns deleted, failed (and their names) and elapsed.
+        """
+        start = time.perf_counter()
+        deleted, failed = asyncio.run(self.erase_async(prefix=prefix, names=names, batch_size=batch_size, max_concurrency=max_concurrency))
+        elapsed = time.perf_counter() - start
 
-        container_client.close()
-        storage_client.close() 
+        print(f"{deleted} blobs in container '{self.container_name}'{f' with prefix {prefix!r}' if prefix else ''} deleted ({len(failed)} failed) in {elapsed:.2f}s.")
 
-    def upload_to_container(self, data, erase_container=False, overwrite=False):
+        return {"deleted": deleted, "failed": len(failed), "failed_names": failed, "elapsed": round(elapsed, 2)}
+
+    def delete_from_container(self, names, batch_size=256, max_concurrency=8):
+        return self.erase_container(names=list(names), batch_size=batch_size, max_concurrency=max_concurrency)
+
+    def get_blob_name(self, name, names, overwrite=False):
+        """
+            Resolve name collisions locally against the container listing: 'name', 'name_1', 'name_2'...
+        """
+        if not overwrite:
+            base, iterator = name, 0
+            while name in names:
+                iterator += 1
+                name = base + f"_{iterator}"
+
+        names.add(name)
+        return name
+
+    def iter_blobs(self, data, names, overwrite=False):
+        """
+            Yields (blob name, content): one json blob per chunk, or json-lines packs of pack_size chunks / pack_bytes
+        """
+        if not self.pack_size:
+            for chunk in data:
+                chunk[self.title_field] = self.get_blob_name(chunk[self.title_field], names, overwrite) # for coherency
+                yield chunk[self.title_field], dumps(chunk, self.vector_encoding)
+            return
+
+        def pack_names():
+            # 'pack-00000.jsonl', 'pack-00001.jsonl'... skipping the names already in the container
+            i = 0
+            while True:
+                name = f"pack-{i:05d}.jsonl"
+                if overwrite or name not in names:
+                    names.add(name)
+                    yield name
+                i += 1
+
+        pack_name = pack_names()
+        lines, n_bytes = [], 0
+
+        for chunk in data:
+            line = dumps(chunk, self.vector_encoding)
+
+            if lines and (len(lines) >= self.pack_size or n_bytes + len(line) + 1 > self.pack_bytes):
+                yield next(pack_name), b"\n".join(lines)
+                lines, n_bytes = [], 0
+
+            lines.append(line)
+            n_bytes += len(line) + 1
+
+        if lines:
+            yield next(pack_name), b"\n".join(lines)
+
+    async def upload_async(self, data, overwrite=False, max_concurrency=16):
+        storage_client = AsyncBlobServiceClient(account_url=self.storage_account_url, credential=self.storage_api_key)
+
+        uploaded, failed, n_bytes = 0, [], 0
+
+        async with storage_client:
+            container_client = storage_client.get_container_client(self.container_name)
+
+            # one listing instead of an exists() call per chunk
+            names = set() if overwrite else {name async for name in container_client.list_blob_names()}
+
+            semaphore = asyncio.Semaphore(max_concurrency)
+            tasks = set()
+
+            async def upload(name, content):
+                nonlocal uploaded, failed, n_bytes
+                try:
+                    await container_client.upload_blob(name, content, overwrite=overwrite)
+                    uploaded += 1
+                    n_bytes += len(content)
+                except Exception as e:
+                    failed.append(name)
+                    print(f"Could not write + {name} ({e})")
+                finally:
+                    semaphore.release()
+
+            # data may be a stream (pipeline sink), pull it off the event loop
+            iterator = self.iter_blobs(data, names, overwrite)
+            while (blob := await asyncio.to_thread(next, iterator, None)) is not None:
+                await semaphore.acquire()
+                task = asyncio.create_task(upload(*blob))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+            await asyncio.gather(*tasks)
+
+        return uploaded, failed, n_bytes
+
+    def upload_to_container(self, data, erase_container=False, overwrite=False, max_concurrency=16):
+        """
+            Upload the chunks as json blobs, concurrently. Returns a summary with the throughput.
+        """
         if erase_container:
             self.erase_container()
 
-        blob_service_client = self.get_storage_client()
-        
-        for chunk in data:
-            local_file_name = chunk[self.title_field]
-
-            blob_client = self.get_blob_client(storage_client=blob_service_client, file_name=local_file_name)
-            
-            if not overwrite:
-                iterator = 0
-                while blob_client.exists():
-                    local_file_name = chunk[self.title_field] + f"_{iterator+1}"
-                    blob_client = self.get_blob_client(storage_client=blob_service_client, file_name=local_file_name)
-                
-                chunk[self.title_field] = local_file_name # for coherency
+        start = time.perf_counter()
+        uploaded, failed, n_bytes = asyncio.run(self.upload_async(data, overwrite=overwrite, max_concurrency=max_concurrency))
+        elapsed = time.perf_counter() - start
 
-            try:
-                blob_client.upload_blob(json.dumps(chunk), overwrite=overwrite)
-                print("\n   Uploaded to Azure Storage as blob: " + local_file_name)
-            except Exception as e:
-                print(f"Could not write + {local_file_name} ({e})")
-
-            blob_client.close() # add try-except
-        
-        blob_service_client.close() # add try-except
+        summary = {"uploaded": uploaded,
+                   "failed": len(failed),
+                   "failed_names": failed,
+                   "elapsed": round(elapsed, 2),
+                   "blobs_per_second": round(uploaded / elapsed, 1) if elapsed else 0.0,
+                   "mb_per_second": round(n_bytes / 1e6 / elapsed, 2) if elapsed else 0.0}
+
+        print(f"Uploaded {uploaded} blobs to '{self.container_name}' ({len(failed)} failed) in {summary['elapsed']}s: "
+              f"{summary['blobs_per_second']} blobs/s, {summary['mb_per_second']} MB/s")
+
+        return summary
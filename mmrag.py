@@ -1,4 +1,4 @@
-from utils.azure_utils import get_response, SEARCH_TYPES
+from utils.azure_utils import get_response, build_filter, get_facets, format_facets, SEARCH_TYPES
 
 from pydantic import BaseModel, Field
 from typing import List
@@ -31,7 +31,7 @@ class Response(BaseModel):
     answer: str = Field("Comprehensive but compact answer to the user query grounded on the provided sources cited with their tags, i.e. [doc_i]")
 
 
-def main(search_type: str, use_history: bool = True):
+def main(search_type: str, use_history: bool = True, search_kwargs: dict = {}, facets: list = None):
     history = []
     
     while True:
@@ -68,7 +68,7 @@ def main(search_type: str, use_history: bool = True):
 
         messages = history if use_history else []
 
-        answer, intent, related, sources, error = None, None, None, None, None
+        answer, intent, related, sources, facet_counts, error = None, None, None, None, None, None
         
         spinner_thread = SpinnerThread() # spinner for entertainment while waiting the response
         spinner_thread.start()
@@ -78,11 +78,15 @@ def main(search_type: str, use_history: bool = True):
                                              sys_template=SYSTEM_MESSAGE_TEMPLATE, 
                                              messages=messages, 
                                              search_type=search_type, 
+                                             search_kwargs=search_kwargs,
                                              openai_kwargs={"temperature":0.1, "max_tokens":None},
                                              output_schema=Response) # LLM response + retrieved sources
 
             # extract results from output schema
             related, intent, answer = response.related, response.intent, response.answer
+
+            if facets:
+                facet_counts = get_facets(user_query, facets, filter=search_kwargs.get("filter"))
         except Exception as e:
             error = f"\n⛔ {e}\n"
 
@@ -104,6 +108,9 @@ def main(search_type: str, use_history: bool = True):
                 if sources:
                     print(f"\n📚 Sources:\n\n{sources}")
 
+                if facet_counts:
+                    print(f"\n📊 Facets:\n\n{format_facets(facet_counts)}")
+
                 # update messages history
                 history.append({"role": "user", "content": f"{user_query}"})
                 history.append({"role": "assistant", "content": f"{answer}"})
@@ -131,10 +138,34 @@ if __name__=="__main__":
                         choices=SEARCH_TYPES, 
                         help="type of search (default: 'vector_text')"
     )
+    parser.add_argument("-src",
+                        "--source",
+                        type=str,
+                        default=None,
+                        help="search only the chunks of this source document"
+    )
+    parser.add_argument("-pg",
+                        "--pages",
+                        type=str,
+                        default=None,
+                        help="search only this page range, e.g. '3-7', '12', '3-' or '-7'"
+    )
+    parser.add_argument("-f",
+                        "--facets",
+                        type=str,
+                        nargs="+",
+                        default=None,
+                        help="show the counts of the matches per field, e.g. 'source' or 'page,interval:10'"
+    )
 
     args = parser.parse_args()
 
     use_history = not args.no_history
     search_type = args.search_type
 
-    main(use_history=use_history, search_type=search_type)
+    try:
+        search_filter = build_filter(source=args.source, pages=args.pages)
+    except ValueError as e:
+        parser.error(str(e))
+
+    main(use_history=use_history, search_type=search_type, search_kwargs={"filter": search_filter} if search_filter else {}, facets=args.facets)
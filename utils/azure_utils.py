@@ -1,22 +1,16 @@
 import os
-from dotenv import load_dotenv
-load_dotenv(".env", override=True)
-
-from azure.core.credentials import AzureKeyCredential
-from azure.ai.documentintelligence import DocumentIntelligenceClient
-from azure.search.documents import SearchClient
-from azure.search.documents.models import VectorizedQuery
-
-from index.storage import Storage
-
-from openai import AzureOpenAI
-from langchain_openai.chat_models import AzureChatOpenAI
-from langchain_openai import AzureOpenAIEmbeddings
+import re
+from utils.env import load_env
+load_env()
 
 from pydantic import BaseModel
 from typing import Optional, Dict, List
+from functools import lru_cache
 
 from utils.utils import format_sources
+from utils.index_pointer import get_active_index
+
+# SDK clients are imported inside the getters to keep imports fast and free of side effects
 
 
 openai_endpoint = os.getenv("OPENAI_ENDPOINT")
@@ -25,6 +19,7 @@ openai_api_key = os.getenv("OPENAI_API_KEY")
 
 chat_deployment = os.getenv("CHAT_DEPLOYMENT")
 embedding_deployment = os.getenv("EMBEDDING_DEPLOYMENT")
+embedding_dimensions = int(os.getenv("EMBEDDING_DIMENSIONS")) if os.getenv("EMBEDDING_DIMENSIONS") else None
 
 document_endpoint = os.getenv("DOCUMENT_ENDPOINT")
 document_api_key = os.getenv("DOCUMENT_API_KEY")
@@ -42,6 +37,7 @@ def get_chatopenai_client():
     """
     Returns an instance of the AzureChatOpenAI client.
     """
+    from langchain_openai.chat_models import AzureChatOpenAI
     
     return AzureChatOpenAI(
         azure_endpoint=openai_endpoint,
@@ -54,6 +50,7 @@ def get_openai_client():
     """
     Returns an instance of the AzureOpenAI client.
     """
+    from openai import AzureOpenAI
     
     return AzureOpenAI(
         api_version=openai_api_version,
@@ -65,6 +62,8 @@ def get_document_client():
     """
     Returns an instance of the DocumentIntelligenceClient client.
     """
+    from azure.core.credentials import AzureKeyCredential
+    from azure.ai.documentintelligence import DocumentIntelligenceClient
 
     return DocumentIntelligenceClient(
             endpoint=document_endpoint, 
@@ -75,45 +74,117 @@ def get_search_client():
     """
     Returns an instance of the SearchClient client.
     """
+    from azure.core.credentials import AzureKeyCredential
+    from azure.search.documents import SearchClient
 
     return SearchClient(
         endpoint=search_endpoint,
         credential=AzureKeyCredential(search_api_key),
-        index_name=index_name
+        index_name=get_active_index(index_name) # follows blue/green swaps
     )
 
 def get_embeddings_client():
     """
     Returns an instance of the AzureOpenAIEmbeddings client.
     """
+    from langchain_openai import AzureOpenAIEmbeddings
 
     return AzureOpenAIEmbeddings(
         azure_endpoint=openai_endpoint,
         openai_api_version=openai_api_version,
         api_key=openai_api_key,
-        model=embedding_deployment
+        model=embedding_deployment,
+        dimensions=embedding_dimensions
     )
 
+@lru_cache(maxsize=None)
+def get_embedding_cache():
+    """
+    Returns the embedding cache shared with the ingestion (one per process).
+    """
+    from utils.embedding_cache import EmbeddingCache
+
+    return EmbeddingCache()
+
+@lru_cache(maxsize=None)
+def get_storage():
+    """
+    Returns the Storage shared across queries (keeps the container snapshot in memory).
+    """
+    from index.storage import Storage
+
+    return Storage()
+
 def get_sources_from_container():
     """
     Returns all the blobs contents present in a given container.
     """
-    stor = Storage()
-    chunks = stor.list_container()
+    chunks = get_storage().list_container()
     return chunks
 
 def get_embedding(text):
     """
-    Returns the embedding from the OpenAIEmbeddings client.
+    Returns the embedding from the OpenAIEmbeddings client, or from the embedding cache.
     """
-    client = get_embeddings_client()
-    embedding = client.embed_query(text=text)
+    cache = get_embedding_cache()
+
+    embedding = cache.get(embedding_deployment, embedding_dimensions, text)
+
+    if embedding is None:
+        client = get_embeddings_client()
+        embedding = client.embed_query(text=text)
+        cache.set(embedding_deployment, embedding_dimensions, text, embedding)
+
     return embedding
 
-def retrieve(search_query: str, use_text=True, use_vector=True, use_semantic=False, top=5, knn=10):
+PAGES_RE = re.compile(r"^\s*(\d*)\s*(-?)\s*(\d*)\s*$")
+
+def build_filter(source: Optional[str] = None, pages: Optional[str] = None):
+    """
+    Returns an OData filter scoping the search to a source document and/or a page range, e.g. pages='3-7', '12', '3-' or '-7'.
+    Raises ValueError on a malformed page range.
+    """
+    clauses = []
+
+    if source:
+        clauses.append("source eq '{}'".format(source.replace("'", "''")))
+
+    if pages:
+        match = PAGES_RE.match(pages)
+        if not match or not (match.group(1) or match.group(3)):
+            raise ValueError(f"Invalid page range '{pages}', expected e.g. '3-7', '12', '3-' or '-7'")
+
+        first, dash, last = match.groups()
+        if not dash: # single page
+            last = first
+
+        if first and last and int(first) > int(last):
+            raise ValueError(f"Invalid page range '{pages}', first page is after the last one")
+
+        if first:
+            clauses.append(f"page ge {int(first)}")
+        if last:
+            clauses.append(f"page le {int(last)}")
+
+    return " and ".join(clauses) or None
+
+def get_facets(search_query: str, facets: List[str], filter: Optional[str] = None):
+    """
+    Returns the facet counts of the text matches, e.g. {"source": [{"value": "doc.pdf", "count": 12}, ...]}.
+    """
+    result = retrieve(search_query, use_text=True, use_vector=False, top=0, filter=filter, facets=facets)
+    return result.get_facets() or {}
+
+def format_facets(facets: Dict):
+    return "\n".join([f"{field}: " + ", ".join([f"{x['value']} ({x['count']})" for x in values]) for field, values in facets.items()])
+
+def retrieve(search_query: str, use_text=True, use_vector=True, use_semantic=False, top=5, knn=10, filter: Optional[str] = None, facets: Optional[List[str]] = None):
     """
     Returns the retrieved results from the Azure Search client.
+    filter is an OData expression on the filterable fields (page, source), facets e.g. ["source", "page,interval:10"].
     """
+    from azure.search.documents.models import VectorizedQuery
+
     client = get_search_client()
 
     if use_vector:
@@ -126,6 +197,8 @@ def retrieve(search_query: str, use_text=True, use_vector=True, use_semantic=Fal
                 VectorizedQuery(vector=search_vector, k_nearest_neighbors=knn, fields="vector")] if use_vector else None,
             query_type="semantic" if use_semantic else None, 
             semantic_configuration_name=semant_config_name if use_semantic else None,
+            filter=filter, # applied before ranking, also to the vector candidates
+            facets=facets,
     )
     return result
 
@@ -145,6 +218,9 @@ def get_response(query: str, sys_template: str, messages: Optional[List[Dict]] =
         sources = get_sources_from_container()
     else:
         sources = retrieve(query, use_text=use_text_search, use_vector=use_vector_search, use_semantic=use_semantic_search, **search_kwargs)
+
+        if debug and search_kwargs.get("facets"):
+            print(sources.get_facets())
     
     sources_formatted, sources_list = format_sources(sources)
 
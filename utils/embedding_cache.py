@@ -0,0 +1,68 @@
+import os
+import hashlib
+
+from typing import List, Optional
+
+import numpy as np
+from diskcache import Cache
+
+
+DTYPES = ("float32", "float16")
+
+
+class EmbeddingCache():
+    """
+        Disk-backed LRU cache of embedding vectors keyed by (deployment, dimensions, sha256(text)).
+        Backed by diskcache (SQLite), so several processes can share it.
+    """
+
+    def __init__(self, cache_dir: str = None, size_limit: int = 2**30, dtype: str = "float32"):
+        assert dtype in DTYPES
+
+        self.cache_dir = cache_dir or os.getenv("EMBEDDING_CACHE_DIR", "data/embedding_cache")
+        self.dtype = dtype
+
+        self.cache = Cache(self.cache_dir, size_limit=size_limit, eviction_policy="least-recently-used")
+
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, deployment: str, dimensions: Optional[int], text: str) -> str:
+        return "{}:{}:{}".format(deployment, dimensions or "", hashlib.sha256(text.encode("utf-8")).hexdigest())
+
+    def encode(self, vector: List[float]):
+        return (self.dtype, np.asarray(vector, dtype=self.dtype).tobytes())
+
+    def decode(self, value) -> List[float]:
+        dtype, data = value
+        return np.frombuffer(data, dtype=dtype).astype(np.float32).tolist()
+
+    def get(self, deployment: str, dimensions: Optional[int], text: str) -> Optional[List[float]]:
+        value = self.cache.get(self.get_key(deployment, dimensions, text))
+
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return self.decode(value)
+
+    def set(self, deployment: str, dimensions: Optional[int], text: str, vector: List[float]):
+        self.cache.set(self.get_key(deployment, dimensions, text), self.encode(vector))
+
+    def get_many(self, deployment: str, dimensions: Optional[int], texts: List[str]) -> List[Optional[List[float]]]:
+        return [self.get(deployment, dimensions, text) for text in texts]
+
+    def set_many(self, deployment: str, dimensions: Optional[int], texts: List[str], vectors: List[List[float]]):
+        with self.cache.transact():
+            for text, vector in zip(texts, vectors):
+                self.set(deployment, dimensions, text, vector)
+
+    def stats(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.cache),
+                "size": self.cache.volume()}
+
+    def close(self):
+        self.cache.close()
@@ -0,0 +1,11 @@
+from functools import lru_cache
+
+from dotenv import load_dotenv, find_dotenv
+
+
+@lru_cache(maxsize=None)
+def load_env():
+    """
+    Loads the repository .env file once per process (its values override the environment).
+    """
+    return load_dotenv(find_dotenv(), override=True)
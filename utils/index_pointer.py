@@ -0,0 +1,59 @@
+import os
+import json
+
+
+# base index name (INDEX_NAME) -> versioned index currently serving queries, see create_index --blue-green
+POINTER_FILE = os.getenv("INDEX_POINTER_FILE", "data/index_pointer.json")
+
+# base index name -> indexes that served it before, most recent first (index names cannot start with '_')
+HISTORY_KEY = "_history"
+
+pointer_cache = {"mtime": None, "pointers": {}}
+
+
+def load_pointers():
+    try:
+        mtime = os.path.getmtime(POINTER_FILE)
+    except OSError:
+        return {}
+
+    # re-read only when the file was swapped, so running apps follow the swap
+    if mtime != pointer_cache["mtime"]:
+        with open(POINTER_FILE, "r") as fin:
+            pointer_cache["pointers"] = json.load(fin)
+        pointer_cache["mtime"] = mtime
+
+    return pointer_cache["pointers"]
+
+def get_active_index(base_name):
+    """
+    Returns the index currently serving base_name (base_name itself if it was never swapped).
+    """
+    return load_pointers().get(base_name, base_name)
+
+def get_previous_indexes(base_name):
+    """
+    Returns the indexes that served base_name before the active one, most recent first.
+    """
+    return load_pointers().get(HISTORY_KEY, {}).get(base_name, [])
+
+def set_active_index(base_name, index_name):
+    """
+    Atomically repoints base_name to index_name.
+    """
+    pointers = load_pointers()
+
+    # the index serving until now is the rollback target, see Index.delete_old_versions
+    history = dict(pointers.get(HISTORY_KEY, {}))
+    previous = pointers.get(base_name, base_name)
+    if previous != index_name:
+        history[base_name] = [previous] + [x for x in history.get(base_name, []) if x not in (previous, index_name)]
+
+    pointers = {**pointers, base_name: index_name, HISTORY_KEY: history}
+
+    os.makedirs(os.path.dirname(POINTER_FILE) or ".", exist_ok=True)
+
+    tmp_path = POINTER_FILE + ".tmp"
+    with open(tmp_path, "w") as fout:
+        json.dump(pointers, fout, indent=2)
+    os.replace(tmp_path, POINTER_FILE)
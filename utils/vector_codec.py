@@ -0,0 +1,66 @@
+import base64
+from typing import List, Dict
+
+import numpy as np
+import orjson
+
+
+ENCODINGS = ("float32", "float16", "int8")
+
+SIDECAR_SUFFIX = "_encoded"
+
+
+def encode_vector(vector: List[float], encoding: str = "float32") -> Dict:
+    """
+        Base64 of the vector bytes, int8 stores the scale to dequantize (v ~ q * scale)
+    """
+    assert encoding in ENCODINGS
+
+    array = np.asarray(vector, dtype=np.float32)
+    encoded = {"dtype": encoding}
+
+    if encoding == "int8":
+        scale = float(np.abs(array).max()) / 127 or 1.0
+        array = np.round(array / scale).astype(np.int8)
+        encoded["scale"] = scale
+    else:
+        array = array.astype(encoding)
+
+    encoded["data"] = base64.b64encode(array.tobytes()).decode("ascii")
+
+    return encoded
+
+def decode_vector(encoded: Dict) -> List[float]:
+    array = np.frombuffer(base64.b64decode(encoded["data"]), dtype=encoded["dtype"]).astype(np.float32)
+
+    if "scale" in encoded:
+        array = array * np.float32(encoded["scale"])
+
+    return array.tolist()
+
+def encode_chunk(chunk: Dict, encoding: str = None, vector_field: str = "vector") -> Dict:
+    """
+        Move the vector to its side-car field, e.g. 'vector' -> 'vector_encoded' (no-op without encoding)
+    """
+    if not encoding or chunk.get(vector_field) is None:
+        return chunk
+
+    chunk = dict(chunk)
+    chunk[vector_field + SIDECAR_SUFFIX] = encode_vector(chunk.pop(vector_field), encoding)
+
+    return chunk
+
+def decode_chunk(chunk: Dict, vector_field: str = "vector") -> Dict:
+    if vector_field + SIDECAR_SUFFIX not in chunk:
+        return chunk
+
+    chunk = dict(chunk)
+    chunk[vector_field] = decode_vector(chunk.pop(vector_field + SIDECAR_SUFFIX))
+
+    return chunk
+
+def dumps(chunk: Dict, encoding: str = None, vector_field: str = "vector") -> bytes:
+    return orjson.dumps(encode_chunk(chunk, encoding, vector_field), option=orjson.OPT_SERIALIZE_NUMPY)
+
+def loads(data, vector_field: str = "vector") -> Dict:
+    return decode_chunk(orjson.loads(data), vector_field)